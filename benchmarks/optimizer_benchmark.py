@@ -0,0 +1,166 @@
+"""Headless benchmark of the TourOptimizer on synthetic tour plans.
+
+Generates plans with random children around a school, haversine distance and duration matrices
+and a random start assignment, runs the full optimization with fixed seeds and writes runtime,
+moves evaluated per second, final cost and the gap to a reference run to a JSON file.
+
+Example:
+    python -m benchmarks.optimizer_benchmark --output bench_new.json --reference bench_old.json
+    python -m benchmarks.optimizer_benchmark --quick
+"""
+from datetime import datetime
+from typing import Dict, List, Tuple
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import time
+import numpy as np
+from src.optimizing.child import Child, School, Stop, create_location_id
+from src.optimizing.distance_matrix import haversine_matrix
+from src.optimizing.tour_optimizer import TourOptimizer
+
+DETOUR_FACTOR = 1.3  # Road distance per great-circle distance
+SPEED = 30 / 3.6  # m/s
+SIBLING_SHARE = 0.1  # Share of children living at the address of another child
+
+
+def generate_instance(n_children: int, capacity: int, seed: int, radius_km: float = 15.0,
+                      center: Tuple[float, float] = (49.79, 9.95)):
+    """Synthetic plan of n_children around a school, filled into tours of the given capacity at random.
+
+    Returns:
+        distance matrix, duration matrix, stops, school positions and node index, ready for the TourOptimizer
+    """
+    rng = np.random.default_rng(seed)
+    school = School("school", "Schule", "", "Schulstraße", "1", "97070", "Würzburg", *center)
+
+    # Uniform in a disc around the school, some siblings share an address
+    angle = rng.uniform(0, 2 * np.pi, n_children)
+    distance = np.sqrt(rng.uniform(0, 1, n_children)) * radius_km
+    lat = center[0] + distance / 111.32 * np.cos(angle)
+    lon = center[1] + distance / (111.32 * np.cos(np.radians(center[0]))) * np.sin(angle)
+    siblings = np.flatnonzero(rng.uniform(0, 1, n_children) < SIBLING_SHARE)
+    homes = rng.integers(0, n_children, len(siblings))
+    lat[siblings], lon[siblings] = lat[homes], lon[homes]
+
+    n_tours = int(np.ceil(n_children / capacity))
+    tour_ids = rng.permutation(np.arange(n_children) % n_tours)
+    children = [Child(f"child-{k}", f"Kind {k}", "", "", "", "", "", round(float(lat[k]), 6), round(float(lon[k]), 6),
+                      school.id, int(tour_ids[k])) for k in range(n_children)]
+
+    # Co-located children of a tour are one stop, like OptimizingDataset.group_children_into_stops
+    stops_by_key: Dict[Tuple[int, str], Stop] = {}
+    for child in children:
+        location_id = create_location_id(child)
+        stops_by_key.setdefault((child.tour_id, location_id), Stop(location_id, [])).children.append(child)
+    stops = list(stops_by_key.values())
+
+    points = {create_location_id(child): (child.lat, child.lon) for child in children}
+    points[create_location_id(school)] = (school.lat, school.lon)
+    node_index = {node_id: index for index, node_id in enumerate(points)}
+    distances = (haversine_matrix(list(points.values())) * DETOUR_FACTOR).astype(np.float32)
+    durations = distances / SPEED
+    return distances, durations, stops, {school.id: node_index[create_location_id(school)]}, node_index
+
+
+def run_case(n_children: int, capacity: int, seed: int, iterations: int, time_budget: float, chains: int) -> Dict:
+    """Optimize one synthetic plan and collect the benchmark numbers."""
+    distances, durations, stops, school_positions, node_index = generate_instance(n_children, capacity, seed)
+    optimizer = TourOptimizer(distances, stops, school_positions, node_index, max_capacity=capacity,
+                              duration_matrix=durations, seed=seed)
+    initial_cost = sum(optimizer.calculate_tour_cost(tour) for tour in optimizer.original_tours.values())
+
+    start = time.perf_counter()
+    result = optimizer.full_optimization(inter_tour_iterations=iterations, chains=chains, time_budget=time_budget)
+    runtime = time.perf_counter() - start
+
+    final_cost = sum(optimizer.calculate_tour_cost(tour) for tour in result['final_tours'].values())
+    inter = result['inter_optimization'] or {}
+    inter_chains = inter.get('chains') or [inter]
+    moves_evaluated = sum(chain.get('moves_evaluated', 0) for chain in inter_chains)
+    inter_runtime = sum(chain.get('runtime', 0) for chain in inter_chains)
+    return {
+        'case': f"n{n_children}-c{capacity}-s{seed}",
+        'children': n_children,
+        'stops': len(stops),
+        'tours': len(optimizer.original_tours),
+        'capacity': capacity,
+        'seed': seed,
+        'runtime': runtime,
+        'inter_runtime': inter_runtime,
+        'iterations': inter.get('iterations', 0),
+        'moves_evaluated': moves_evaluated,
+        'moves_per_second': moves_evaluated / inter_runtime if inter_runtime else None,
+        'moves_accepted': sum(chain.get('moves_accepted', 0) for chain in inter_chains),
+        'initial_cost': initial_cost,
+        'final_cost': final_cost,
+        'improvement': (initial_cost - final_cost) / initial_cost if initial_cost else 0.0,
+    }
+
+
+def load_reference(path: str) -> Dict[str, float]:
+    """Final cost per case of an earlier benchmark run."""
+    with open(path, "r") as f:
+        return {case['case']: case['final_cost'] for case in json.load(f)['results']}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(sizes: List[int], capacities: List[int], seeds: List[int], iterations: int,
+                  time_budget: float = None, chains: int = 1, reference: Dict[str, float] = None) -> Dict:
+    results = []
+    for n_children in sizes:
+        for capacity in capacities:
+            for seed in seeds:
+                case = run_case(n_children, capacity, seed, iterations, time_budget, chains)
+                reference_cost = (reference or {}).get(case['case'])
+                case['reference_cost'] = reference_cost
+                case['gap'] = (case['final_cost'] - reference_cost) / reference_cost if reference_cost else None
+                results.append(case)
+                gap = f", gap {case['gap']:+.2%}" if case['gap'] is not None else ""
+                logging.info(f"{case['case']}: {case['runtime']:.2f}s, cost {case['final_cost']:.0f} "
+                             f"({case['improvement']:.1%} better than the start{gap})")
+    return {
+        'created': datetime.now().isoformat(timespec="seconds"),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'settings': {'iterations': iterations, 'time_budget': time_budget, 'chains': chains},
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tour optimizer on synthetic plans")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 50, 100, 250, 500, 1000],
+                        help="number of children per plan")
+    parser.add_argument("--capacities", type=int, nargs="+", default=[4, 8], help="max children per tour")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--iterations", type=int, default=10000, help="inter tour iterations")
+    parser.add_argument("--time-budget", type=float, default=None, help="time budget per plan in seconds")
+    parser.add_argument("--chains", type=int, default=1, help="parallel annealing chains")
+    parser.add_argument("--reference", default=None, help="earlier benchmark output to calculate the gap against")
+    parser.add_argument("--output", default="optimizer_benchmark.json")
+    parser.add_argument("--quick", action="store_true", help="small plans and a single seed only")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.sizes, args.seeds = [20, 100], [0]
+    benchmark = run_benchmark(args.sizes, args.capacities, args.seeds, args.iterations, args.time_budget,
+                              args.chains, load_reference(args.reference) if args.reference else None)
+    with open(args.output, "w") as f:
+        json.dump(benchmark, f, indent=2)
+    logging.info(f"Benchmark results written to {args.output}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    main()
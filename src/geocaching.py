@@ -1,57 +1,133 @@
+from collections import OrderedDict
 from threading import Lock
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import logging
+import os
+import time
+from src.geocoding.address_normalization import canonical_address_from_string
+from src.geocoding.batch_geocoding import BatchGeocoder
+from src.geocoding.geocoding_store import GeocodingStore, Location, get_geocoding_store
+from src.geocoding.osmr_geocoding import GeoCoder
 
 
 class GeocodingCache:
-    def __init__(self):
-        self.cache = {}
+    """Geocoding cache of the whole app, keyed by the canonical address.
+
+    A bounded LRU in memory sits in front of the persistent GeocodingStore. Failed lookups ((None, None))
+    are cached as well, but expire after negative_ttl seconds so transient failures are retried.
+    It behaves like a dict (get, in, [] =, update) and can be passed to the BatchGeocoder.
+    """
+    def __init__(self, store: GeocodingStore = None, max_size: int = None, negative_ttl: float = None):
+        """
+        Args:
+            store: persistent store behind the LRU, None keeps the results in memory only
+            max_size: max number of addresses in memory, default GEOCODING_CACHE_SIZE
+            negative_ttl: seconds a failed lookup is cached, default GEOCODING_NEGATIVE_TTL
+        """
+        self.store = store
+        self.max_size = max_size or int(os.getenv("GEOCODING_CACHE_SIZE", 10000))
+        self.negative_ttl = negative_ttl if negative_ttl is not None else float(os.getenv("GEOCODING_NEGATIVE_TTL", 86400))
+        self.cache: "OrderedDict[str, Tuple[Optional[float], Optional[float], float]]" = OrderedDict()
         self.lock = Lock()
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.lookup_seconds = 0.0
 
-    def get_location(self, gmaps, address: str) -> Optional[Dict]:
+    def _remember(self, key: str, entry: Tuple[Optional[float], Optional[float], float]):
+        self.cache[key] = entry
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def get(self, key: str, default=None) -> Optional[Location]:
+        """(lat, lon) of a canonical address, default if unknown or an expired failure."""
+        start = time.perf_counter()
         with self.lock:
-            if address in self.cache:
-                logging.info(f"✅ Cache Hit on: {address}")
-                return self.cache[address]
-
-        try:
-            logging.info(f"🔍 Geocoding: {address}")
-            result = gmaps.geocode(address)
-            if result:
-                location = result[0]['geometry']['location']
-                with self.lock:
-                    self.cache[address] = location
-                logging.info(f"✅ Geocoded: {address} -> {location['lat']:.4f}, {location['lng']:.4f}")
-                return location
-        except Exception as e:
-            logging.error(f"❌ Error when Geocoding adress: {address} with: {e}")
-        return None
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+        from_store = entry is None and self.store is not None
+        if from_store:
+            entry = self.store.lookup(key)
 
+        with self.lock:
+            if entry is not None and entry[0] is None and time.time() - entry[2] > self.negative_ttl:
+                self.expired += 1
+                self.cache.pop(key, None)
+                entry = None
+            if entry is None:
+                self.misses += 1
+            elif from_store:
+                self.store_hits += 1
+                self._remember(key, entry)
+            else:
+                self.memory_hits += 1
+            self.lookup_seconds += time.perf_counter() - start
+        return entry[:2] if entry is not None else default
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __getitem__(self, key: str) -> Location:
+        location = self.get(key)
+        if location is None:
+            raise KeyError(key)
+        return location
+
+    def __setitem__(self, key: str, location: Location):
+        self.update({key: location})
+
+    def update(self, locations: Dict[str, Location]):
+        """Cache all locations, written to the store in one transaction."""
+        now = time.time()
+        with self.lock:
+            for key, (lat, lon) in locations.items():
+                self._remember(key, (lat, lon, now))
+        if self.store is not None:
+            self.store.update(locations)
+
+    def stats(self) -> Dict[str, float]:
+        """Hit, miss and lookup latency counters since the start of the process."""
+        with self.lock:
+            lookups = self.memory_hits + self.store_hits + self.misses
+            return {
+                'size': len(self.cache),
+                'memory_hits': self.memory_hits,
+                'store_hits': self.store_hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'hit_rate': (self.memory_hits + self.store_hits) / lookups if lookups else 0.0,
+                'avg_lookup_ms': 1000 * self.lookup_seconds / lookups if lookups else 0.0,
+            }
+
+    def get_location(self, gmaps, address: str) -> Optional[Dict]:
+        return self.geocode_addresses_batch([address], gmaps).get(address)
 
     def geocode_addresses_batch(self, addresses: List[str], gmaps) -> Dict[str, Dict]:
         """Geocodiert alle Adressen und cached die Ergebnisse"""
-        locations = {}
-        uncached_addresses = []
-
-        # Prüfe welche Adressen bereits gecacht sind
-        for address in addresses:
-            cached_location = self.get_location(gmaps, address)
-            if cached_location:
-                locations[address] = cached_location
-            else:
-                uncached_addresses.append(address)
+        keys = [canonical_address_from_string(address) for address in addresses]
+
+        def progress(done: int, total: int):
+            if done % 5 == 0 or done == total:
+                logging.info(f"⏳ Geocoding Progress: {done}/{total}")
+
+        # Nur ungecachte Adressen werden parallel und rate limitiert geocodiert
+        results = BatchGeocoder(GeoCoder("", gmaps), "GM").geocode_batch(
+            keys, [{"address": address} for address in addresses], cache=self, progress=progress)
+        return {address: {'lat': result.lat, 'lng': result.lon} for address, result in zip(addresses, results)
+                if result.found}
 
-        logging.info(f"📍 {len(addresses) - len(uncached_addresses)}/{len(addresses)} Adressen aus Cache")
-        logging.info(f"🔍 {len(uncached_addresses)} neue API Calls erforderlich")
 
-        # Geocodiere nur uncached Adressen
-        for i, address in enumerate(uncached_addresses):
-            location = self.get_location(gmaps, address)
-            if location:
-                locations[address] = location
+_cache = None
+_cache_lock = Lock()
 
-            # Progress Update
-            if (i + 1) % 5 == 0 or i == len(uncached_addresses) - 1:
-                logging.info(f"⏳ Geocoding Progress: {i + 1}/{len(uncached_addresses)}")
 
-        return locations
\ No newline at end of file
+def get_geocoding_cache() -> GeocodingCache:
+    """Return the process wide geocoding cache, in memory only if the geocoding store can't be opened."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = GeocodingCache(get_geocoding_store())
+        return _cache
@@ -0,0 +1,95 @@
+from typing import Optional, Tuple
+import re
+import unicodedata
+
+COUNTRY = "Deutschland"
+_COUNTRIES = {"deutschland", "germany", "de"}
+_UMLAUTS = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+# Street suffixes folded to one spelling, applied to the lower case text with umlauts replaced
+_STREET_SUFFIXES = [
+    (r"(str\.?|strasse|strase)\b", "str"),
+    (r"(pl\.?|platz)\b", "platz"),
+]
+_DISTRICT_SEPARATOR = re.compile(r"\s+-\s+|\s*/\s*|\s*,?\s+(?:ot|stadtteil)\.?\s+", re.IGNORECASE)
+_POSTCODE = re.compile(r"\b\d{5}\b")
+_HOUSENUMBER = re.compile(r"^(.*?)\s+(\d+\s*[a-z]?(?:\s*[-/]\s*\d*\s*[a-z]?)?)$", re.IGNORECASE)
+
+
+def _fold(text: Optional[str]) -> str:
+    """Lower case, umlauts as ae/oe/ue/ss, other accents removed and whitespace collapsed."""
+    text = unicodedata.normalize("NFC", str(text or "")).lower().translate(_UMLAUTS)
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    return " ".join(text.split())
+
+
+def split_region(region: Optional[str]) -> Tuple[str, Optional[str]]:
+    """Split a region like 'Würzburg - Versbach' or 'Würzburg OT Versbach' into city and district."""
+    parts = _DISTRICT_SEPARATOR.split(str(region or "").strip(), maxsplit=1)
+    city = parts[0].strip()
+    district = parts[1].strip() if len(parts) > 1 and parts[1].strip() else None
+    return city, district
+
+
+def normalize_street(street: Optional[str]) -> str:
+    """'Kaiser-Wilhelm-Straße' and 'Kaiser Wilhelm Str.' both become 'kaiser wilhelmstr'."""
+    street = _fold(street).replace("-", " ")
+    for pattern, replacement in _STREET_SUFFIXES:
+        street = re.sub(pattern, replacement, street)
+    # 'Hauptstr' and 'Haupt str' are the same street
+    street = re.sub(r"(\w) (str|weg|platz)\b", r"\1\2", street)
+    return " ".join(street.replace(".", " ").split())
+
+
+def normalize_housenumber(housenumber: Optional[str]) -> str:
+    """'12 A' becomes '12a', '3 - 5' becomes '3-5'."""
+    return re.sub(r"\s+", "", _fold(housenumber))
+
+
+def split_housenumber(street: str) -> Tuple[str, str]:
+    """Split 'Hauptstr. 12a' into street and housenumber, the housenumber is empty if there is none."""
+    match = _HOUSENUMBER.match(" ".join(str(street or "").split()))
+    return (match.group(1), match.group(2)) if match else (str(street or "").strip(), "")
+
+
+def canonical_address(street: Optional[str], housenumber: Optional[str], postcode: Optional[str],
+                      region: Optional[str]) -> str:
+    """Canonical cache key of an address, the same for every spelling of the address.
+
+    The district of the region is dropped, the postcode already tells the places apart.
+    """
+    city, _ = split_region(region)
+    street_part = " ".join(part for part in (normalize_street(street), normalize_housenumber(housenumber)) if part)
+    place = " ".join(part for part in (_fold(postcode), _fold(city)) if part)
+    return f"{street_part}, {place}"
+
+
+def parse_address(address: str) -> Tuple[str, str, str, str]:
+    """Split a formatted address like 'Hauptstr. 5, 97070 Würzburg, Deutschland' or
+    'Hauptstr. 5, 97070, Würzburg - Versbach, Deutschland' into street, housenumber, postcode and region."""
+    parts = [part.strip() for part in str(address).split(",") if part.strip()]
+    if parts and parts[-1].lower() in _COUNTRIES:
+        parts = parts[:-1]
+    if not parts:
+        return "", "", "", ""
+
+    street, housenumber = split_housenumber(parts[0])
+
+    place = " ".join(parts[1:])
+    postcode = _POSTCODE.search(place)
+    region = _POSTCODE.sub("", place) if postcode else place
+    return street, housenumber, postcode.group(0) if postcode else "", " ".join(region.split())
+
+
+def canonical_address_from_string(address: str) -> str:
+    """Canonical cache key of a formatted address string, see canonical_address()."""
+    return canonical_address(*parse_address(address))
+
+
+def query_address(street: Optional[str], postcode: Optional[str], region: Optional[str]) -> str:
+    """Free text query of an address for geocoders without structured queries (Google Maps).
+
+    Args:
+        street: street with housenumber
+    """
+    place = " ".join(str(part).strip() for part in (postcode, region) if part and str(part).strip())
+    return ", ".join(part for part in (" ".join(str(street or "").split()), place, COUNTRY) if part)
@@ -0,0 +1,168 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import BoundedSemaphore, Lock
+from typing import Callable, Dict, List, Optional
+import logging
+import os
+import time
+
+
+class TokenBucket:
+    """Thread safe token bucket, acquire() blocks until the next request may be sent."""
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RequestLimiter:
+    """Limit of the requests of one coding type, shared by all batches of the process."""
+    def __init__(self, max_concurrent: int, rate: float = None):
+        """
+        Args:
+            max_concurrent: requests running at once
+            rate: max requests per second, None for no limit
+        """
+        self.max_concurrent = max_concurrent
+        self.semaphore = BoundedSemaphore(max_concurrent)
+        self.bucket = TokenBucket(rate) if rate else None
+
+    @contextmanager
+    def request(self):
+        """Block until a request may be sent, it is counted as running until the context exits."""
+        with self.semaphore:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            yield
+
+
+_limiters: Dict[str, RequestLimiter] = {}
+_limiters_lock = Lock()
+
+
+def get_request_limiter(coding_type: str) -> RequestLimiter:
+    """Return the process wide request limiter of a coding type.
+
+    Google Maps requests go through a token bucket (GEOCODING_GM_RATE requests per second) with at most
+    GEOCODING_GM_WORKERS at once, the local Nominatim gets at most GEOCODING_LOCAL_WORKERS requests at once.
+    """
+    with _limiters_lock:
+        if coding_type not in _limiters:
+            if coding_type == "GM":
+                limiter = RequestLimiter(int(os.getenv("GEOCODING_GM_WORKERS", 8)),
+                                         float(os.getenv("GEOCODING_GM_RATE", 40)))
+            elif coding_type == "OFFLINE":
+                # In process lookups, threads would only wait for the GIL
+                limiter = RequestLimiter(1)
+            else:
+                limiter = RequestLimiter(int(os.getenv("GEOCODING_LOCAL_WORKERS", 4)))
+            _limiters[coding_type] = limiter
+        return _limiters[coding_type]
+
+
+@dataclass
+class GeocodingResult:
+    """Geocoding outcome of a single address."""
+    address: str
+    lat: Optional[float]
+    lon: Optional[float]
+    status: str  # one of BatchGeocoder.CACHED, GEOCODED, NOT_FOUND, ERROR
+
+    @property
+    def found(self) -> bool:
+        return self.lat is not None and self.lon is not None
+
+
+class BatchGeocoder:
+    """Geocode many addresses at once with a GeoCoder.
+
+    The input is deduplicated, cached addresses are answered from the cache and the remaining ones
+    are resolved concurrently. All batches of a coding type share one request limiter, see
+    get_request_limiter, so concurrent batches (sessions) together keep to the provider limits.
+    """
+    CACHED = "cached"
+    GEOCODED = "geocoded"
+    NOT_FOUND = "not_found"
+    ERROR = "error"
+
+    def __init__(self, geocoder, coding_type: str, max_workers: int = None):
+        """
+        Args:
+            geocoder: GeoCoder sending the single requests
+            coding_type: 'LOCAL', 'GM' or 'OFFLINE'
+            max_workers: threads of this batch, default is the request limit of the coding type
+        """
+        self.geocoder = geocoder
+        self.coding_type = coding_type
+        self.limiter = get_request_limiter(coding_type)
+        self.max_workers = max_workers or self.limiter.max_concurrent
+
+    def _geocode_one(self, address: str, params: dict) -> GeocodingResult:
+        try:
+            with self.limiter.request():
+                # The GeoCoder changes the params in place
+                lat, lon = self.geocoder.geocode(self.coding_type, **dict(params))
+        except Exception as e:
+            logging.error(f"Error geocoding address {address}: {e}")
+            return GeocodingResult(address, None, None, self.ERROR)
+        if lat and lon:
+            return GeocodingResult(address, lat, lon, self.GEOCODED)
+        logging.warning(f"Geocoding failed for address: {address}")
+        return GeocodingResult(address, None, None, self.NOT_FOUND)
+
+    def geocode_batch(self, addresses: List[str], params: List[dict], cache=None,
+                      progress: Callable[[int, int], None] = None) -> List[GeocodingResult]:
+        """Geocode all addresses, the results are in the order of the input.
+
+        Args:
+            addresses: address strings, used as cache keys
+            params: request parameters of every address for the GeoCoder (street, city, postcode, ...)
+            cache: mapping address -> (lat, lon) with get() and update(), e.g. a dict or the GeocodingStore
+            progress: called with the number of finished and all uncached addresses
+        """
+        unique: Dict[str, dict] = {}
+        for address, address_params in zip(addresses, params):
+            unique.setdefault(address, address_params)
+
+        results: Dict[str, GeocodingResult] = {}
+        for address in unique:
+            cached = cache.get(address) if cache is not None else None
+            if cached is not None:
+                lat, lon = cached
+                results[address] = GeocodingResult(address, lat, lon, self.CACHED if lat is not None else self.NOT_FOUND)
+        pending = [address for address in unique if address not in results]
+        logging.info(f"📍 {len(unique) - len(pending)}/{len(unique)} Adressen aus Cache, "
+                     f"{len(pending)} neue Anfragen ({self.coding_type})")
+
+        if pending:
+            new_locations = {}
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as pool:
+                futures = [pool.submit(self._geocode_one, address, unique[address]) for address in pending]
+                for done, future in enumerate(as_completed(futures), start=1):
+                    result = future.result()
+                    results[result.address] = result
+                    # Failed requests are not cached, the next batch tries them again
+                    if result.status != self.ERROR:
+                        new_locations[result.address] = (result.lat, result.lon)
+                    if progress is not None:
+                        progress(done, len(pending))
+            # One write for the whole batch, a single transaction for the persistent store
+            if cache is not None and new_locations:
+                cache.update(new_locations)
+
+        return [results[address] for address in addresses]
@@ -0,0 +1,123 @@
+from threading import Lock
+from typing import Dict, Iterable, Optional, Tuple
+import json
+import logging
+import os
+import sqlite3
+import time
+from src.geocoding.address_normalization import canonical_address_from_string
+
+# (lat, lon) of an address, (None, None) if it could not be geocoded
+Location = Tuple[Optional[float], Optional[float]]
+
+
+class GeocodingStore:
+    """Persistent geocoding results keyed by the canonical address, see address_normalization.
+
+    The results live in a local SQLite file, so they are shared by all sessions and survive restarts
+    and new uploads. Addresses are read one at a time when they are needed, new results are written
+    in one transaction per batch. It behaves like the dict the geocoding used before (get, in, [] =, update).
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS geocodes (
+                    address TEXT PRIMARY KEY,
+                    lat REAL,
+                    lon REAL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS seeds (path TEXT PRIMARY KEY, imported INTEGER NOT NULL)")
+
+    def lookup(self, address: str) -> Optional[Tuple[Optional[float], Optional[float], float]]:
+        """(lat, lon, time it was stored) of an address, None if it is unknown."""
+        with self.lock:
+            row = self.connection.execute("SELECT lat, lon, updated_at FROM geocodes WHERE address = ?",
+                                          (address,)).fetchone()
+        return tuple(row) if row else None
+
+    def get(self, address: str, default=None) -> Optional[Location]:
+        row = self.lookup(address)
+        return row[:2] if row else default
+
+    def __contains__(self, address: str) -> bool:
+        return self.get(address) is not None
+
+    def __getitem__(self, address: str) -> Location:
+        location = self.get(address)
+        if location is None:
+            raise KeyError(address)
+        return location
+
+    def __setitem__(self, address: str, location: Location):
+        self.update({address: location})
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM geocodes").fetchone()[0]
+
+    def update(self, locations: Dict[str, Location]):
+        """Store all locations in one transaction."""
+        now = time.time()
+        rows = [(address, lat, lon, now) for address, (lat, lon) in locations.items()]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO geocodes (address, lat, lon, updated_at) "
+                                        "VALUES (?, ?, ?, ?)", rows)
+
+    def items(self) -> Iterable[Tuple[str, Location]]:
+        with self.lock:
+            rows = self.connection.execute("SELECT address, lat, lon FROM geocodes").fetchall()
+        return [(address, (lat, lon)) for address, lat, lon in rows]
+
+    def seed_from_json(self, path: str) -> int:
+        """Import an address -> [lat, lon] JSON file once, known addresses are kept.
+
+        Returns:
+            number of imported addresses, 0 if the file was imported before or doesn't exist
+        """
+        if not path or not os.path.exists(path):
+            return 0
+        with self.lock:
+            if self.connection.execute("SELECT 1 FROM seeds WHERE path = ?", (path,)).fetchone():
+                return 0
+        try:
+            with open(path, "r") as f:
+                locations = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read the geocoding seed {path}: {e}")
+            return 0
+
+        now = time.time()
+        # Older files are keyed by the formatted address, the store by its canonical form
+        rows = [(canonical_address_from_string(address), location[0], location[1], now)
+                for address, location in locations.items() if location and len(location) == 2]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO geocodes (address, lat, lon, updated_at) "
+                                        "VALUES (?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT INTO seeds (path, imported) VALUES (?, ?)", (path, len(rows)))
+        logging.info(f"Imported {len(rows)} geocoded addresses from {path}")
+        return len(rows)
+
+
+_store = None
+_store_lock = Lock()
+
+
+def get_geocoding_store() -> Optional[GeocodingStore]:
+    """Return the process wide geocoding store, seeded from ADRESS_PATH on first use, None if it can't be opened."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            try:
+                _store = GeocodingStore(os.getenv("GEOCODING_CACHE_PATH", "./geocoding_cache.sqlite"))
+                _store.seed_from_json(os.getenv("ADRESS_PATH"))
+            except sqlite3.Error as e:
+                logging.error(f"Could not open the geocoding store: {e}")
+                _store = None
+                return None
+        return _store
@@ -0,0 +1,140 @@
+from threading import Lock
+from typing import Optional, Tuple
+import logging
+import os
+import re
+import numpy as np
+import pandas as pd
+from src.geocoding.address_normalization import normalize_housenumber, normalize_street
+
+_NUMBER = re.compile(r"(\d+)([a-z]?)")
+_ARRAYS = ("keys", "numbers", "suffixes", "lat", "lon")
+
+
+def _parse_number(housenumber) -> Tuple[int, str]:
+    """'12 a' -> (12, 'a'), ranges like '3-5' use the first number, (-1, '') without a number."""
+    match = _NUMBER.search(normalize_housenumber(housenumber))
+    return (int(match.group(1)), match.group(2)) if match else (-1, "")
+
+
+def _street_key(postcode, street) -> bytes:
+    return f"{str(postcode or '').strip()}|{normalize_street(street)}".encode("ascii", "ignore")
+
+
+class AddressIndex:
+    """Address points of a local extract, sorted by postcode, street and housenumber.
+
+    The arrays are saved as .npy files and memory mapped, so loading the index is instant and the
+    OS shares its pages between processes. A lookup is a binary search for the street followed
+    by a search for the housenumber within the street.
+    """
+    def __init__(self, path: str):
+        """
+        Args:
+            path: directory of an index written by build()
+        """
+        self.path = path
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in _ARRAYS}
+        self.keys = arrays["keys"]
+        self.numbers = arrays["numbers"]
+        self.suffixes = arrays["suffixes"]
+        self.lat = arrays["lat"]
+        self.lon = arrays["lon"]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @staticmethod
+    def build(source: str, path: str) -> "AddressIndex":
+        """Build the index from a CSV or Parquet extract with the columns street, housenumber, postcode, lat, lon.
+
+        Reading Parquet needs pyarrow or fastparquet.
+        """
+        if source.endswith(".parquet"):
+            points = pd.read_parquet(source, columns=["street", "housenumber", "postcode", "lat", "lon"])
+        else:
+            points = pd.read_csv(source, usecols=["street", "housenumber", "postcode", "lat", "lon"],
+                                 dtype={"street": str, "housenumber": str, "postcode": str})
+        points = points.dropna(subset=["street", "postcode", "lat", "lon"])
+
+        keys = np.array([_street_key(postcode, street) for postcode, street in zip(points["postcode"], points["street"])])
+        parsed = [_parse_number(number) for number in points["housenumber"]]
+        numbers = np.array([number for number, _ in parsed], dtype=np.int32)
+        suffixes = np.array([suffix.encode("ascii") for _, suffix in parsed], dtype="S1")
+        order = np.lexsort((suffixes, numbers, keys))
+
+        os.makedirs(path, exist_ok=True)
+        arrays = {"keys": keys, "numbers": numbers, "suffixes": suffixes,
+                  "lat": points["lat"].to_numpy(np.float64), "lon": points["lon"].to_numpy(np.float64)}
+        for name in _ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), arrays[name][order])
+        logging.info(f"Built the offline geocoding index {path} with {len(order)} address points from {source}")
+        return AddressIndex(path)
+
+    def lookup(self, street: str, housenumber: str, postcode: str) -> Tuple[Optional[float], Optional[float]]:
+        """(lat, lon) of an address, (None, None) if the street is not in the index.
+
+        A missing housenumber is interpolated between the closest known numbers on the same side
+        of the street (same parity), or between any numbers if a side has no points.
+        """
+        key = _street_key(postcode, street)
+        start, end = np.searchsorted(self.keys, key, "left"), np.searchsorted(self.keys, key, "right")
+        if start == end:
+            return None, None
+        number, suffix = _parse_number(housenumber)
+        numbers = self.numbers[start:end]
+        if number < 0:
+            # Without a housenumber the middle of the street
+            middle = start + (end - start) // 2
+            return float(self.lat[middle]), float(self.lon[middle])
+
+        first, last = np.searchsorted(numbers, number, "left"), np.searchsorted(numbers, number, "right")
+        if first < last:
+            exact = np.flatnonzero(self.suffixes[start + first:start + last] == suffix.encode("ascii"))
+            point = start + first + (exact[0] if len(exact) else 0)
+            return float(self.lat[point]), float(self.lon[point])
+
+        numbered = numbers >= 0
+        same_side = np.flatnonzero(numbered & (numbers % 2 == number % 2))
+        candidates = same_side if len(same_side) >= 2 else np.flatnonzero(numbered)
+        if len(candidates) == 0:
+            return self.lookup(street, "", postcode)
+        below = candidates[numbers[candidates] < number]
+        above = candidates[numbers[candidates] > number]
+        if len(below) == 0 or len(above) == 0:
+            # Beyond the known numbers, the closest point of the street
+            point = start + (above[0] if len(above) else below[-1])
+            return float(self.lat[point]), float(self.lon[point])
+        low, high = start + below[-1], start + above[0]
+        share = (number - self.numbers[low]) / (self.numbers[high] - self.numbers[low])
+        return (float(self.lat[low] + share * (self.lat[high] - self.lat[low])),
+                float(self.lon[low] + share * (self.lon[high] - self.lon[low])))
+
+
+_index = None
+_index_lock = Lock()
+
+
+def get_address_index() -> Optional[AddressIndex]:
+    """Return the process wide offline address index, built from OFFLINE_GEOCODING_PATH if it is missing or outdated.
+
+    The index is kept in OFFLINE_GEOCODING_INDEX (default: the extract path with .index appended).
+    Returns None if no extract is configured or it can't be read.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            source = os.getenv("OFFLINE_GEOCODING_PATH")
+            path = os.getenv("OFFLINE_GEOCODING_INDEX", f"{source}.index" if source else None)
+            if not path:
+                logging.error("OFFLINE_GEOCODING_PATH is not set, the offline geocoder has no address points.")
+                return None
+            try:
+                keys = os.path.join(path, "keys.npy")
+                outdated = source and os.path.exists(source) and (
+                        not os.path.exists(keys) or os.path.getmtime(keys) < os.path.getmtime(source))
+                _index = AddressIndex.build(source, path) if outdated else AddressIndex(path)
+            except (OSError, ValueError, KeyError, ImportError) as e:
+                logging.error(f"Could not load the offline geocoding index {path}: {e}")
+                return None
+        return _index
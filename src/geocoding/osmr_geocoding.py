@@ -1,47 +1,73 @@
-import logging
+from typing import Callable, List
 import googlemaps
 import requests
+from src.geocoding.address_normalization import parse_address, query_address, split_housenumber, split_region
+from src.geocoding.batch_geocoding import BatchGeocoder, GeocodingResult
+from src.geocoding.offline_geocoding import get_address_index
 
 class GeoCoder:
     def __init__(self, base_url: str, gmaps: googlemaps.Client = None):
-        self.base_url = base_url.rstrip("/")
+        self.base_url = (base_url or "").rstrip("/")
         self.gmaps = gmaps
 
     def geocode(self, coding_type: str, **params):
         """Return a list of geocoding results from local Nominatim (structured query)"""
+        if "housenumber" in params:
+            # Nominatim and Google both expect the housenumber as part of the street
+            params["street"] = f"{params.get('street', '')} {params.pop('housenumber')}".strip()
         if coding_type == "LOCAL":
             return self.geocode_local(**params)
+        elif coding_type == "OFFLINE":
+            return self.geocode_offline(**params)
         elif coding_type == "GM":
-            address = f"{params.get('street', '')}, {params.get('city', '')}, {params.get('postcode', '')}"
+            address = params.get("address") or query_address(params.get("street"), params.get("postcode"),
+                                                             params.get("city"))
             return self.geocode_google_maps(address)
         return None
 
+    def geocode_batch(self, coding_type: str, addresses: List[str], params: List[dict], cache=None,
+                      progress: Callable[[int, int], None] = None) -> List[GeocodingResult]:
+        """Geocode many addresses concurrently and rate limited, see BatchGeocoder.geocode_batch"""
+        return BatchGeocoder(self, coding_type).geocode_batch(addresses, params, cache=cache, progress=progress)
+
     def geocode_local(self, **params):
+        """Geocode an address with the local Nominatim, (None, None) if it is not found.
+
+        Transport and HTTP errors are raised, so batches don't cache them as not found.
+        """
         if "city" in params:
-            params["city"] = params["city"] if "-" not in params["city"] else params["city"].split("-")[0].strip()
-        try:
-            if "format" not in params:
-                params["format"] = "json"
-
-            response = requests.get(f"{self.base_url}/search", params=params, timeout=10)
-            response.raise_for_status()
-            result = response.json()
-            if result and len(result) > 0:
-                lat = float(result[0]["lat"])
-                lon = float(result[0]["lon"])
-                return lat, lon
-            return None, None
-        except Exception as e:
-            logging.info(f"Error calling local geocoder: {e}")
+            params["city"], _ = split_region(params["city"])
+        if "format" not in params:
+            params["format"] = "json"
+
+        response = requests.get(f"{self.base_url}/search", params=params, timeout=10)
+        response.raise_for_status()
+        result = response.json()
+        if result and len(result) > 0:
+            lat = float(result[0]["lat"])
+            lon = float(result[0]["lon"])
+            return lat, lon
+        return None, None
+
+    def geocode_offline(self, **params):
+        """Geocode an address with the local address point index, no network request is sent."""
+        index = get_address_index()
+        if index is None:
             return None, None
+        if "address" in params:
+            street, housenumber, postcode, _ = parse_address(params["address"])
+        else:
+            street, housenumber = split_housenumber(params.get("street", ""))
+            postcode = params.get("postcode", "")
+        return index.lookup(street, housenumber, postcode)
 
     def geocode_google_maps(self, address):
-        """Geocode an address using the Google Maps API."""
-        try:
-            result = self.gmaps.geocode(address)
-            if result:
-                location = result[0]["geometry"]["location"]
-                return location["lat"], location["lng"]
-        except Exception as e:
-            logging.info(f"Error geocoding with Google Maps: {e}")
+        """Geocode an address using the Google Maps API.
+
+        Transport errors and API errors like OVER_QUERY_LIMIT are raised, ZERO_RESULTS gives (None, None).
+        """
+        result = self.gmaps.geocode(address)
+        if result:
+            location = result[0]["geometry"]["location"]
+            return location["lat"], location["lng"]
         return None, None
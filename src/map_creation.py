@@ -1,14 +1,17 @@
 import traceback
+import threading
+from concurrent.futures import as_completed
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 import folium
-import time
 import polyline
 import logging
 from typing import Tuple, Optional
 from src.utils.geolocation import GeoLocation
 from src.optimizing.osmr.osm_routing import OSMR_Module
+from src.optimizing.osmr.osrm_client import get_osrm_client
 
 
 def create_single_map(tour_data: Tuple[int, pd.Series], idx: int, progress_callback=None) -> Optional[
@@ -200,15 +203,34 @@ def create_maps_for_tours(tour_id_to_df: dict, geocoding_cache, gmaps, optimized
         else:
             status_text.text(f"Erstelle Karten: {completed_tours}/{total_tours} Touren abgeschlossen")
 
-    for i, (tour_id, tour_element) in enumerate(tour_id_to_df.items()):
-        status_text.text(f"Verarbeite Tour {i + 1}/{total_tours}...")
-
-        map_obj, tour_distance = create_single_map((tour_id, tour_element), i, update_progress)
+    # Maps are created concurrently in the OSRM client pool, the workers need the script context
+    # of this session to access the session state
+    ctx = get_script_run_ctx()
+
+    def create_map_in_context(tour_data, idx):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return create_single_map(tour_data, idx)
+
+    client = get_osrm_client()
+    status_text.text(f"Verarbeite {total_tours} Touren...")
+    futures = {client.submit(create_map_in_context, (tour_id, tour_element), i): tour_id
+               for i, (tour_id, tour_element) in enumerate(tour_id_to_df.items())}
+
+    created_maps = {}
+    for completed, future in enumerate(as_completed(futures), start=1):
+        created_maps[futures[future]] = future.result()
+        update_progress(completed)
+
+    # Keep the original tour order in the result dicts
+    for tour_id in tour_id_to_df.keys():
+        result = created_maps.get(tour_id)
+        if not result:
+            continue
+        map_obj, tour_distance = result
         if map_obj:
             maps[tour_id] = map_obj
         if tour_distance:
             tour_distances[tour_id] = round(tour_distance)
-        time.sleep(0.1)
 
     progress_bar.progress(1.0)
     status_text.text(f"✅ Kartenerstellung abgeschlossen: {len(maps)}/{total_tours} Karten erstellt")
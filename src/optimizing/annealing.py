@@ -0,0 +1,83 @@
+from typing import List, Sequence, Tuple
+import numpy as np
+
+# (tour, order as positions into the stops, cost) of every tour touched by a move
+TourChange = Tuple[int, np.ndarray, float]
+
+
+class AnnealingState:
+    """Current and best solution of the simulated annealing, kept in flat arrays.
+
+    Every tour is a row of orders padded with -1, alongside its length and cost. The assignment
+    array maps every stop to its tour, loads holds the number of children per tour. Moves are
+    written in place and return the previous orders and costs, the best solution is a copy of the arrays
+    instead of a deepcopy of all stops.
+    """
+    def __init__(self, tours: Sequence[np.ndarray], costs: Sequence[float], n_stops: int, width: int = None,
+                 stop_loads: np.ndarray = None):
+        """
+        Args:
+            tours: order of every tour as positions into the stops
+            costs: cost of every tour
+            n_stops: number of stops in all tours
+            width: expected max number of stops in a tour, the rows grow if a tour gets longer
+            stop_loads: number of children of every stop, defaults to one
+        """
+        width = max([len(tour) for tour in tours] + [width or 0, 1])
+        self.orders = np.full((len(tours), width), -1, dtype=np.intp)
+        self.lengths = np.zeros(len(tours), dtype=np.intp)
+        self.costs = np.zeros(len(tours))
+        self.assignment = np.full(n_stops, -1, dtype=np.intp)
+        self.stop_loads = np.ones(n_stops, dtype=np.intp) if stop_loads is None else np.asarray(stop_loads)
+        self.loads = np.zeros(len(tours), dtype=np.intp)
+        self.total = 0.0
+        self.best_orders = None
+        for k, (tour, cost) in enumerate(zip(tours, costs)):
+            self._write(k, np.asarray(tour, dtype=np.intp), cost)
+
+        self.best_orders = self.orders.copy()
+        self.best_lengths = self.lengths.copy()
+        self.best_costs = self.costs.copy()
+        self.best_total = self.total
+
+    def tour(self, k: int) -> np.ndarray:
+        """Order of tour k (a view, copy it before changing the state)."""
+        return self.orders[k, :self.lengths[k]]
+
+    def _grow(self, width: int):
+        padding = ((0, 0), (0, width - self.orders.shape[1]))
+        self.orders = np.pad(self.orders, padding, constant_values=-1)
+        if self.best_orders is not None:
+            self.best_orders = np.pad(self.best_orders, padding, constant_values=-1)
+
+    def _write(self, k: int, tour: np.ndarray, cost: float):
+        if len(tour) > self.orders.shape[1]:
+            self._grow(2 * len(tour))
+        self.total += cost - self.costs[k]
+        self.orders[k, :len(tour)] = tour
+        self.orders[k, len(tour):] = -1
+        self.lengths[k] = len(tour)
+        self.costs[k] = cost
+        self.loads[k] = self.stop_loads[tour].sum()
+        self.assignment[tour] = k
+
+    def apply(self, changes: List[TourChange]) -> List[TourChange]:
+        """Write the new orders and costs of the touched tours and return their previous ones."""
+        previous = [(k, self.tour(k).copy(), self.costs[k]) for k, _, _ in changes]
+        for k, tour, cost in changes:
+            self._write(k, tour, cost)
+        return previous
+
+    def save_best(self) -> bool:
+        """Snapshot the current solution if it is the best one so far."""
+        if self.total >= self.best_total:
+            return False
+        np.copyto(self.best_orders, self.orders)
+        np.copyto(self.best_lengths, self.lengths)
+        np.copyto(self.best_costs, self.costs)
+        self.best_total = self.total
+        return True
+
+    def best_tours(self) -> List[np.ndarray]:
+        """Order of every tour of the best solution."""
+        return [self.best_orders[k, :length].copy() for k, length in enumerate(self.best_lengths)]
@@ -1,4 +1,4 @@
-from typing import Type, Union
+from typing import List, Type, Union
 from dataclasses import dataclass
 import hashlib
 
@@ -26,6 +26,34 @@ class Child(Object):
     school_id: int
     tour_id: int
 
+@dataclass
+class Stop:
+    """Represent a pickup stop of a tour, all children of the tour living at the same location."""
+    id: str  # location id, the node of the stop in the distance matrix
+    children: List[Child]
+
+    @property
+    def school_id(self) -> str:
+        return self.children[0].school_id
+
+    @property
+    def tour_id(self) -> int:
+        return self.children[0].tour_id
+
+    @property
+    def forname(self) -> str:
+        return " / ".join(child.forname for child in self.children)
+
+    @property
+    def surname(self) -> str:
+        return self.children[0].surname
+
+def create_location_id(obj: Object) -> str:
+    """Create an ID shared by all objects at the same location, based on the rounded coordinates."""
+    if obj.lat is None or obj.lon is None:
+        return obj.id  # Not geocoded objects never share a location
+    return f"{obj.lat:.5f},{obj.lon:.5f}"
+
 def create_object_id(obj: Object) -> str:
     """Create a unique ID based on forname, surname, street, and housenumber."""
     unique_string = f"{obj.forname}{obj.surname}{obj.street}{obj.housenumber}"
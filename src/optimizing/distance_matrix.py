@@ -0,0 +1,178 @@
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+
+class DistanceMatrix:
+    """Distance and duration matrix with stable node indices which can be updated node by node.
+
+    Both metrics live side by side in one preallocated array of shape (metrics, capacity, capacity)
+    which grows by doubling its capacity, so adding a node does not copy the matrix. Every node
+    (child or school) keeps its index until it is dropped. Dropped indices are reused by new nodes;
+    compact() removes the remaining holes and renumbers the nodes. Unknown entries are stored as NaN.
+    Entries which are only estimated are flagged: those OSRM failed for are unknown again on the next
+    update, the ones a sparse update did not route as soon as an update requires them.
+    """
+    METRICS = ("distance", "duration")  # meters, seconds
+
+    def __init__(self, capacity: int = 64, dtype: np.dtype = np.float32):
+        self._data = np.full((len(self.METRICS), capacity, capacity), np.nan, dtype=dtype)
+        self._failed = np.zeros((capacity, capacity), dtype=bool)
+        self._estimated = np.zeros((capacity, capacity), dtype=bool)
+        self.size = 0
+        # Explicit node table, index -> node_id (None for free indices) and node_id -> index
+        self.node_ids: List[Optional[str]] = []
+        self.node_index: Dict[str, int] = {}
+        self.points: Dict[str, Tuple[float, float]] = {}
+        self.free: List[int] = []
+
+    def __contains__(self, node_id: str) -> bool:
+        return node_id in self.node_index
+
+    def __len__(self) -> int:
+        return len(self.node_index)
+
+    @property
+    def stacked(self) -> np.ndarray:
+        """View on the used part of all metrics, shape (metrics, size, size) (no copy)."""
+        return self._data[:, :self.size, :self.size]
+
+    @property
+    def values(self) -> np.ndarray:
+        """View on the used part of the distance matrix, indexed by the node indices (no copy)."""
+        return self.metric("distance")
+
+    def metric(self, metric: str) -> np.ndarray:
+        """View on the used part of a single metric (no copy)."""
+        return self._data[self.METRICS.index(metric), :self.size, :self.size]
+
+    def index_of(self, node_id: str) -> int:
+        """Return the matrix index of a node."""
+        return self.node_index[node_id]
+
+    def _grow(self):
+        capacity = max(1, 2 * self._data.shape[1])
+        data = np.full((len(self.METRICS), capacity, capacity), np.nan, dtype=self._data.dtype)
+        data[:, :self.size, :self.size] = self.stacked
+        self._data = data
+        for name in ("_failed", "_estimated"):
+            flags = np.zeros((capacity, capacity), dtype=bool)
+            flags[:self.size, :self.size] = getattr(self, name)[:self.size, :self.size]
+            setattr(self, name, flags)
+
+    def _clear(self, index: int):
+        self._data[:, index, :] = np.nan
+        self._data[:, :, index] = np.nan
+        for flags in (self._failed, self._estimated):
+            flags[index, :] = False
+            flags[:, index] = False
+
+    def add_node(self, node_id: str, point: Tuple[float, float]) -> int:
+        """Add a node with unknown distances and return its index."""
+        if node_id in self.node_index:
+            raise ValueError(f"Node {node_id} is already part of the distance matrix.")
+        if self.free:
+            index = self.free.pop()
+            self.node_ids[index] = node_id
+        else:
+            if self.size == self._data.shape[1]:
+                self._grow()
+            index = self.size
+            self.size += 1
+            self.node_ids.append(node_id)
+        self._clear(index)
+        self.node_index[node_id] = index
+        self.points[node_id] = point
+        return index
+
+    def drop_node(self, node_id: str):
+        """Remove a node, its index is free for the next added node."""
+        index = self.node_index.pop(node_id)
+        del self.points[node_id]
+        self.node_ids[index] = None
+        self._clear(index)
+        self.free.append(index)
+
+    def replace_node(self, node_id: str, point: Tuple[float, float]):
+        """Move a node to a new location, its index stays the same but its distances are unknown."""
+        self.points[node_id] = point
+        self._clear(self.node_index[node_id])
+
+    def sync(self, nodes: Dict[str, Tuple[float, float]]) -> Dict[str, int]:
+        """Bring the matrix in line with the given node_id -> (lat, lon) mapping.
+
+        Returns:
+            number of added, dropped and replaced nodes
+        """
+        changes = {"added": 0, "dropped": 0, "replaced": 0}
+        for node_id in [node_id for node_id in self.node_index if node_id not in nodes]:
+            self.drop_node(node_id)
+            changes["dropped"] += 1
+        for node_id, point in nodes.items():
+            if node_id not in self.node_index:
+                self.add_node(node_id, point)
+                changes["added"] += 1
+            elif self.points[node_id] != point:
+                self.replace_node(node_id, point)
+                changes["replaced"] += 1
+        return changes
+
+    def compact(self):
+        """Remove the indices of dropped nodes and renumber the remaining nodes."""
+        if not self.free:
+            return
+        active = self.active_indices()
+        data = np.full(self._data.shape, np.nan, dtype=self._data.dtype)
+        data[:, :len(active), :len(active)] = self.stacked[np.ix_(range(len(self.METRICS)), active, active)]
+        self._data = data
+        for name in ("_failed", "_estimated"):
+            flags = np.zeros(self._failed.shape, dtype=bool)
+            flags[:len(active), :len(active)] = getattr(self, name)[np.ix_(active, active)]
+            setattr(self, name, flags)
+        self.node_ids = [self.node_ids[index] for index in active]
+        self.node_index = {node_id: index for index, node_id in enumerate(self.node_ids)}
+        self.size = len(active)
+        self.free = []
+
+    def mark_failed(self, indices: List[int], failed: np.ndarray):
+        """Flag entries between the given node indices which OSRM could not deliver (len(indices)^2 mask)."""
+        self._failed[np.ix_(indices, indices)] |= failed
+
+    def forget_failed(self) -> int:
+        """Turn the flagged entries back into unknown ones, so the next update requests them again."""
+        failed = self._failed[:self.size, :self.size]
+        count = int(failed.sum())
+        if count:
+            self.stacked[:, failed] = np.nan
+            failed[...] = False
+        return count
+
+    def mark_estimated(self, indices: List[int], estimated: np.ndarray):
+        """Flag entries between the given node indices which were estimated instead of routed (len(indices)^2 mask)."""
+        self._estimated[np.ix_(indices, indices)] |= estimated
+
+    def forget_estimated(self, indices: List[int], required: np.ndarray) -> int:
+        """Turn the estimated entries among the required ones (len(indices)^2 mask) back into unknown ones."""
+        indices = np.asarray(indices)
+        estimated = self._estimated[np.ix_(indices, indices)] & required
+        count = int(estimated.sum())
+        if count:
+            rows, columns = (indices[positions] for positions in np.nonzero(estimated))
+            self._data[:, rows, columns] = np.nan
+            self._estimated[rows, columns] = False
+        return count
+
+    def active_indices(self) -> List[int]:
+        """Indices of all nodes currently part of the matrix, in ascending order."""
+        return [index for index, node_id in enumerate(self.node_ids) if node_id is not None]
+
+    def active_points(self) -> List[Tuple[float, float]]:
+        """(lat, lon) of all active nodes, in the order of active_indices()."""
+        return [self.points[self.node_ids[index]] for index in self.active_indices()]
+
+
+def haversine_matrix(points: List[Tuple[float, float]], radius: float = 6371000.0) -> np.ndarray:
+    """Vectorised great-circle distances in meters between all (lat, lon) points."""
+    lat, lon = np.radians(np.asarray(points, dtype=float).reshape(-1, 2)).T
+    a = (np.sin((lat[:, None] - lat[None, :]) / 2) ** 2 +
+         np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin((lon[:, None] - lon[None, :]) / 2) ** 2)
+    return 2 * radius * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
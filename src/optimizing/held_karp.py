@@ -0,0 +1,84 @@
+from functools import lru_cache
+from typing import Dict, Sequence, Tuple
+import numpy as np
+from src.optimizing.two_opt import path_cost
+
+
+@lru_cache(maxsize=None)
+def _layers(n: int) -> Tuple[np.ndarray, ...]:
+    """Subset bitmasks of n nodes grouped by their number of nodes"""
+    masks = np.arange(1 << n)
+    sizes = np.array([bin(mask).count("1") for mask in range(1 << n)])
+    return tuple(masks[sizes == size] for size in range(n + 1))
+
+
+def held_karp_path(nodes: Sequence[int], end: int, matrix: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Optimal order of an open path through all nodes which finishes at the end node (the school).
+
+    Bitmask dynamic programming, cost[mask, j] is the cheapest path starting at node j, visiting all
+    nodes of mask and ending at end. Every subset size is computed in one vectorised step.
+
+    Returns:
+        optimal order as positions into nodes and its cost
+    """
+    nodes = np.asarray(nodes)
+    n = len(nodes)
+    if n <= 1:
+        return np.arange(n), path_cost(nodes, end, matrix)
+
+    between = matrix[np.ix_(nodes, nodes)].astype(float)
+    bits = 1 << np.arange(n)
+    cost = np.full((1 << n, n), np.inf)
+    parent = np.zeros((1 << n, n), dtype=np.intp)
+    cost[bits, np.arange(n)] = matrix[nodes, end]
+
+    layers = _layers(n)
+    for size in range(2, n + 1):
+        masks = layers[size]
+        # rest[m, j] is the mask without j, the path continues at some k of the rest
+        rest = masks[:, None] ^ bits[None, :]
+        candidates = between[None, :, :] + cost[rest]
+        best = candidates.argmin(axis=2)
+        values = np.take_along_axis(candidates, best[..., None], axis=2)[..., 0]
+        values[(masks[:, None] & bits[None, :]) == 0] = np.inf
+        cost[masks] = values
+        parent[masks] = best
+
+    mask = (1 << n) - 1
+    current = int(cost[mask].argmin())
+    total = float(cost[mask, current])
+    order = [current]
+    for _ in range(n - 1):
+        mask, current = mask ^ (1 << current), int(parent[mask, current])
+        order.append(current)
+    return np.array(order), total
+
+
+class HeldKarpSolver:
+    """Exact intra tour solver for small tours, memoized by the stop set.
+
+    The memo is keyed by the sorted node indices and the end node, so a set of stops which was
+    solved once (e.g. while simulated annealing swaps children back and forth) is a lookup.
+    Nodes may repeat, co-located stops of different tours share a node.
+    """
+    def __init__(self, matrix: np.ndarray, max_size: int = 9):
+        self.matrix = matrix
+        self.max_size = max_size
+        self.memo: Dict[Tuple[Tuple[int, ...], int], Tuple[np.ndarray, float]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def solve(self, nodes: Sequence[int], end: int) -> Tuple[np.ndarray, float]:
+        """Return the optimal order as positions into nodes and its cost."""
+        nodes = np.asarray(nodes)
+        if len(nodes) > self.max_size:
+            raise ValueError(f"Held-Karp is limited to {self.max_size} nodes, got {len(nodes)}.")
+        sorting = np.argsort(nodes, kind="stable")
+        key = (tuple(nodes[sorting].tolist()), int(end))
+        if key in self.memo:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.memo[key] = held_karp_path(nodes[sorting], end, self.matrix)
+        order, cost = self.memo[key]
+        return sorting[order], cost
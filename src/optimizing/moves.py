@@ -0,0 +1,206 @@
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple
+import numpy as np
+from src.optimizing.annealing import AnnealingState
+
+
+@dataclass
+class Move:
+    """Exchange of the segments a[i1:i2] and b[j1:j2] of two tours, either segment may be empty.
+
+    relocate: a single stop of a is inserted into b at j1 (empty segment of b), at its cheapest position
+    swap: a single stop of a and b are exchanged
+    two_opt_star: the tails of a and b starting at i1 and j1 are exchanged
+    cross_exchange: short segments of a and b are exchanged, keeping their direction
+    """
+    kind: str
+    a: int
+    b: int
+    i1: int
+    i2: int
+    j1: int
+    j2: int
+    delta: float = 0.0
+
+
+def _join(matrix: np.ndarray, previous: int, segment: np.ndarray, following: int) -> float:
+    """Cost of the edges joining a segment between previous (-1 at the open start) and following"""
+    if len(segment) == 0:
+        return matrix[previous, following] if previous >= 0 else 0.0
+    return (matrix[previous, segment[0]] if previous >= 0 else 0.0) + matrix[segment[-1], following]
+
+
+def exchange_delta(matrix: np.ndarray, a: np.ndarray, b: np.ndarray, end: int,
+                   i1: int, i2: int, j1: int, j2: int) -> float:
+    """Cost delta of exchanging the segments a[i1:i2] and b[j1:j2] of two paths ending at the same end node.
+
+    Only the (at most eight) edges at the segment boundaries change, the inner edges of the segments
+    move with them, so the delta is constant time.
+
+    Args:
+        a, b: matrix indices of the stops of both tours in visiting order
+    """
+    previous_a, following_a = a[i1 - 1] if i1 > 0 else -1, a[i2] if i2 < len(a) else end
+    previous_b, following_b = b[j1 - 1] if j1 > 0 else -1, b[j2] if j2 < len(b) else end
+    segment_a, segment_b = a[i1:i2], b[j1:j2]
+    return float(_join(matrix, previous_a, segment_b, following_a) + _join(matrix, previous_b, segment_a, following_b) -
+                 _join(matrix, previous_a, segment_a, following_a) - _join(matrix, previous_b, segment_b, following_b))
+
+
+def apply_exchange(a: np.ndarray, b: np.ndarray, move: Move) -> Tuple[np.ndarray, np.ndarray]:
+    """New orders of both tours after the move."""
+    return (np.concatenate((a[:move.i1], b[move.j1:move.j2], a[move.i2:])),
+            np.concatenate((b[:move.j1], a[move.i1:move.i2], b[move.j2:])))
+
+
+class MoveGenerator:
+    """Random inter tour moves between tours of the same school, checked against the capacity"""
+    KINDS = ("relocate", "swap", "two_opt_star", "cross_exchange")
+
+    def __init__(self, matrix: np.ndarray, stop_nodes: np.ndarray, tour_ends: np.ndarray, max_capacity: int,
+                 weights: Sequence[float] = (0.35, 0.35, 0.15, 0.15), max_segment: int = 3):
+        """
+        Args:
+            matrix: cost matrix
+            stop_nodes: matrix index of every stop
+            tour_ends: matrix index of the school of every tour
+            max_capacity: max number of children per tour
+            weights: how often each of KINDS is proposed
+            max_segment: max number of stops of a segment in a cross exchange
+        """
+        self.matrix = matrix
+        self.stop_nodes = stop_nodes
+        self.tour_ends = tour_ends
+        self.max_capacity = max_capacity
+        self.weights = weights
+        self.max_segment = max_segment
+
+    def propose(self, state: AnnealingState, rng) -> Optional[Move]:
+        """Draw a random move, None if the drawn move is not possible."""
+        kind = rng.choices(self.KINDS, weights=self.weights)[0]
+        a, b = rng.sample(range(len(self.tour_ends)), 2)
+        if self.tour_ends[a] != self.tour_ends[b]:
+            return None
+        size_a, size_b = state.lengths[a], state.lengths[b]
+
+        if kind == "relocate":
+            if size_a == 0:
+                return None
+            i1 = rng.randrange(size_a)
+            return self.evaluate(state, kind, a, b, i1, i1 + 1, *[self.best_insertion(state, state.tour(a)[i1], b)] * 2)
+        if kind == "swap":
+            if size_a == 0 or size_b == 0:
+                return None
+            i1, j1 = rng.randrange(size_a), rng.randrange(size_b)
+            return self.evaluate(state, kind, a, b, i1, i1 + 1, j1, j1 + 1)
+        if kind == "two_opt_star":
+            i1, j1 = rng.randint(0, size_a), rng.randint(0, size_b)
+            if (i1 == size_a and j1 == size_b) or (i1 == 0 and j1 == 0):
+                return None  # Nothing or whole tours exchanged
+            return self.evaluate(state, kind, a, b, i1, size_a, j1, size_b)
+        if size_a == 0 or size_b == 0:
+            return None
+        length_a = rng.randint(1, min(self.max_segment, size_a))
+        length_b = rng.randint(1, min(self.max_segment, size_b))
+        i1, j1 = rng.randint(0, size_a - length_a), rng.randint(0, size_b - length_b)
+        return self.evaluate(state, kind, a, b, i1, i1 + length_a, j1, j1 + length_b)
+
+    def best_insertion(self, state: AnnealingState, stop: int, b: int) -> int:
+        """Position in tour b where inserting the stop adds the least cost, all positions at once."""
+        nodes = self.stop_nodes[state.tour(b)]
+        node = self.stop_nodes[stop]
+        following = np.append(nodes, self.tour_ends[b])
+        added = self.matrix[node, following].astype(float)
+        added[1:] += self.matrix[nodes, node] - self.matrix[nodes, following[1:]]
+        return int(added.argmin())
+
+    def _fits(self, load: int, current_load: int) -> bool:
+        # Tours which are already over capacity in the original plan may not get fuller
+        return load <= self.max_capacity or load <= current_load
+
+    def evaluate(self, state: AnnealingState, kind: str, a: int, b: int,
+                 i1: int, i2: int, j1: int, j2: int) -> Optional[Move]:
+        """Check the capacity of both tours after the move and calculate its delta, None if infeasible."""
+        tour_a, tour_b = state.tour(a), state.tour(b)
+        moved_a = state.stop_loads[tour_a[i1:i2]].sum()
+        moved_b = state.stop_loads[tour_b[j1:j2]].sum()
+        if not (self._fits(state.loads[a] - moved_a + moved_b, state.loads[a]) and
+                self._fits(state.loads[b] - moved_b + moved_a, state.loads[b])):
+            return None
+        delta = exchange_delta(self.matrix, self.stop_nodes[tour_a], self.stop_nodes[tour_b], self.tour_ends[a],
+                               i1, i2, j1, j2)
+        return Move(kind, a, b, i1, i2, j1, j2, delta)
+
+
+def neighbour_lists(matrix: np.ndarray, stop_nodes: np.ndarray, stop_schools: np.ndarray, k: int) -> np.ndarray:
+    """The k nearest stops of every stop going to the same school, nearest first.
+
+    Returns:
+        stops x k array of positions into the stops, -1 where a stop has fewer neighbours
+    """
+    between = matrix[np.ix_(stop_nodes, stop_nodes)].astype(float)
+    between = np.minimum(between, between.T)  # Close in either direction
+    between[stop_schools[:, None] != stop_schools[None, :]] = np.inf
+    np.fill_diagonal(between, np.inf)
+
+    k = min(k, len(stop_nodes) - 1)
+    if k <= 0:
+        return np.full((len(stop_nodes), 0), -1, dtype=np.intp)
+    nearest = np.argpartition(between, k - 1, axis=1)[:, :k]
+    distances = np.take_along_axis(between, nearest, axis=1)
+    order = np.argsort(distances, axis=1)
+    nearest = np.take_along_axis(nearest, order, axis=1)
+    nearest[np.take_along_axis(distances, order, axis=1) == np.inf] = -1
+    return nearest
+
+
+class NeighbourMoveGenerator(MoveGenerator):
+    """Moves between a stop and one of its nearest stops in another tour.
+
+    Random pairs of stops mostly lie on opposite ends of the city and are rejected. Here every
+    move joins a stop x with a close stop y: x is relocated next to y, x and y are swapped, the
+    tails are exchanged so x is followed by y, or a segment starting at x is placed behind y.
+    A share of the moves stays fully random to keep the search diverse.
+    """
+    def __init__(self, matrix: np.ndarray, stop_nodes: np.ndarray, tour_ends: np.ndarray, max_capacity: int,
+                 neighbours: np.ndarray, random_share: float = 0.1, **kwargs):
+        """
+        Args:
+            neighbours: neighbour lists of all stops, see neighbour_lists()
+            random_share: share of fully random moves
+        """
+        super().__init__(matrix, stop_nodes, tour_ends, max_capacity, **kwargs)
+        self.neighbours = neighbours
+        self.random_share = random_share
+
+    def propose(self, state: AnnealingState, rng) -> Optional[Move]:
+        if self.neighbours.shape[1] == 0 or rng.random() < self.random_share:
+            return super().propose(state, rng)
+        x = rng.randrange(len(state.assignment))
+        y = self.neighbours[x, rng.randrange(self.neighbours.shape[1])]
+        if y < 0:
+            return None
+        a, b = state.assignment[x], state.assignment[y]
+        if a == b or self.tour_ends[a] != self.tour_ends[b]:
+            return None
+        size_a, size_b = state.lengths[a], state.lengths[b]
+        position_x = int(np.flatnonzero(state.tour(a) == x)[0])
+        position_y = int(np.flatnonzero(state.tour(b) == y)[0])
+
+        kind = rng.choices(self.KINDS, weights=self.weights)[0]
+        if kind == "relocate":
+            # Right before or after y, whichever is cheaper
+            before = self.evaluate(state, kind, a, b, position_x, position_x + 1, position_y, position_y)
+            after = self.evaluate(state, kind, a, b, position_x, position_x + 1, position_y + 1, position_y + 1)
+            candidates = [move for move in (before, after) if move is not None]
+            return min(candidates, key=lambda move: move.delta) if candidates else None
+        if kind == "swap":
+            return self.evaluate(state, kind, a, b, position_x, position_x + 1, position_y, position_y + 1)
+        if kind == "two_opt_star":
+            return self.evaluate(state, kind, a, b, position_x + 1, size_a, position_y, size_b)
+        if position_y + 1 == size_b:
+            return None
+        length_a = rng.randint(1, min(self.max_segment, size_a - position_x))
+        length_b = rng.randint(1, min(self.max_segment, size_b - position_y - 1))
+        return self.evaluate(state, kind, a, b, position_x, position_x + length_a, position_y + 1,
+                             position_y + 1 + length_b)
@@ -1,318 +1,16 @@
 import os
-from copy import deepcopy
-import random
-from tqdm import tqdm
 import time
-from typing import List, Dict, Tuple
 import streamlit as st
-import numpy as np
+import pandas as pd
 from src.utils.utils import logical_round
-from src.optimizing.child import Child
 from src.optimizing.turn_into_format import OptimizingDataset
 from src.optimizing.draw_changes import TourOptimizationComparator
-
-class TourOptimizer:
-    """Main module for the optimization of the routes"""
-
-    def __init__(self,
-                 distance_matrix: np.ndarray,
-                 children: List[Child],
-                 school_positions: Dict[int, int],  # school_id -> index in matrix
-                 max_capacity: int = 8):
-        """
-        Args:
-            distance_matrix: NxN matrix containing distances between children
-            children: list of all children objects
-            school_positions: mapping from school_id to index in distance matrix
-            max_capacity: max number of children per tour
-        """
-        self.distance_matrix = distance_matrix
-        self.children = children
-        self.school_positions = school_positions
-        self.max_capacity = max_capacity
-
-
-        # Generate tours by assigning every child to its corresponding tour
-        self.tours = self._organize_tours()
-
-    def _organize_tours(self) -> Dict[int, List[Child]]:
-        """Organize Children into tours based on their tour_id"""
-        tours = {}
-        for child in self.children:
-            if child.tour_id not in tours:
-                tours[child.tour_id] = []
-            tours[child.tour_id].append(child)
-        return tours
-
-    def calculate_tour_cost(self, tour: List[Child]) -> float:
-        """
-        Calculate the total tour costs
-
-        Args:
-            tour: Liste von Kindern in der Reihenfolge der Abholung
-            metric: 'duration' oder 'distance'
-        """
-        if "children_to_index" not in st.session_state:
-            return 0
-        children_to_index = st.session_state["children_to_index"]
-        cost = 0
-        if len(tour) == 0:
-            return cost
-
-        matrix = self.distance_matrix
-
-        # First calculate the cost from the first child to the last one
-        for i in range(len(tour) - 1):
-            cost += matrix[children_to_index[tour[i].id], children_to_index[tour[i + 1].id]]
-
-        # Add the costs for the last child to the school
-        school_idx = self.school_positions[tour[0].school_id]
-        cost += matrix[children_to_index[tour[-1].id], school_idx]
-
-        return cost
-
-    def optimize_tour_order_2opt(self, tour_id: int) -> Tuple[List[Child], float]:
-        """
-        Optimize the intra tour order using 2-opt algorithm
-
-        return:
-            optimized tour and the improvement in cost
-        """
-        tour = self.tours[tour_id].copy()
-        if len(tour) <= 2:
-            return tour, 0
-
-        initial_cost = self.calculate_tour_cost(tour)
-        improved = True
-
-        while improved:
-            improved = False
-            for i in range(1, len(tour) - 1):
-                for j in range(i + 1, len(tour)):
-                    new_tour = tour[:i] + tour[i:j][::-1] + tour[j:]
-                    new_cost = self.calculate_tour_cost(new_tour)
-
-                    if new_cost < self.calculate_tour_cost(tour):
-                        tour = new_tour
-                        improved = True
-                        break
-                if improved:
-                    break
-
-        final_cost = self.calculate_tour_cost(tour)
-        improvement = initial_cost - final_cost
-
-        return tour, improvement
-
-    def optimize_all_tours_intra(self) -> Dict[str, any]:
-        """
-        Optimize all tours individually using 2-opt
-
-        Returns:
-            dict with total improvement and details per tour
-        """
-        total_improvement = 0
-        optimized_tours = {}
-        improvements = []
-
-        for tour_id in self.tours.keys():
-            optimized_tour, improvement = self.optimize_tour_order_2opt(tour_id)
-            optimized_tours[tour_id] = optimized_tour
-            total_improvement += improvement
-            improvements.append({
-                'tour_id': tour_id,
-                'improvement': improvement,
-                'original_cost': self.calculate_tour_cost(self.tours[tour_id]),
-                'optimized_cost': self.calculate_tour_cost(optimized_tour)
-            })
-
-        return {
-            'total_improvement': total_improvement,
-            'optimized_tours': optimized_tours,
-            'details': improvements
-        }
-
-    def try_swap_children(self, child1: Child, child2: Child,
-                          tour1: List[Child], tour2: List[Child]) -> Tuple[bool, float]:
-        """
-        Test if swapping two children between two tours improves the cost
-
-        Returns:
-            (is_improved, savings)
-        """
-        if child1.schule_id != tour2[0].schule_id or child2.schule_id != tour1[0].schule_id:
-            return False, 0  # Verschiedene Schulen
-
-        current_cost = (self.calculate_tour_cost(tour1) +
-                        self.calculate_tour_cost(tour2))
-
-        new_tour1 = [child2 if c.id == child1.id else c for c in tour1]
-        new_tour2 = [child1 if c.id == child2.id else c for c in tour2]
-
-        new_tour1, _ = self.optimize_tour_order_2opt_list(new_tour1)
-        new_tour2, _ = self.optimize_tour_order_2opt_list(new_tour2)
-
-        new_cost = (self.calculate_tour_cost(new_tour1) +
-                    self.calculate_tour_cost(new_tour2))
-
-        improvement = current_cost - new_cost
-        return improvement > 0, improvement
-
-    def optimize_tour_order_2opt_list(self, tour: List[Child]) -> Tuple[List[Child], float]:
-        """2-opt for a given list of children"""
-        if len(tour) <= 2:
-            return tour, 0
-
-        initial_cost = self.calculate_tour_cost(tour)
-        improved = True
-
-        while improved:
-            improved = False
-            for i in range(1, len(tour) - 1):
-                for j in range(i + 1, len(tour)):
-                    new_tour = tour[:i] + tour[i:j][::-1] + tour[j:]
-                    new_cost = self.calculate_tour_cost(new_tour)
-
-                    if new_cost < self.calculate_tour_cost(tour):
-                        tour = new_tour
-                        improved = True
-                        break
-                if improved:
-                    break
-
-        final_cost = self.calculate_tour_cost(tour)
-        return tour, initial_cost - final_cost
-
-    def optimize_inter_tour_swaps(self, max_iterations=1000,
-                                  temperature=100, cooling_rate=0.995) -> Dict[str, any]:
-        """
-        Optimize inter-tour swaps using Simulated Annealing
-
-        Args:
-            max_iterations: max iteration
-            temperature: temperature
-            cooling_rate: cooling
-        """
-        current_tours = deepcopy(self.tours)
-        best_tours = deepcopy(current_tours)
-
-        current_cost = sum(self.calculate_tour_cost(tour)
-                           for tour in current_tours.values())
-        best_cost = current_cost
-
-        swaps_performed = []
-        temp = temperature
-
-        for iteration in tqdm(range(max_iterations)):
-            tour_ids = list(current_tours.keys())
-            tour1_id, tour2_id = random.sample(tour_ids, 2)
-
-            tour1 = current_tours[tour1_id]
-            tour2 = current_tours[tour2_id]
-
-            if len(tour1) < 1 or len(tour2) < 1:
-                continue
-
-            if tour1[0].school_id != tour2[0].school_id:
-                continue
-
-            child1 = random.choice(tour1)
-            child2 = random.choice(tour2)
-
-            # Berechne Kosten vor Swap
-            old_cost = (self.calculate_tour_cost(tour1) +
-                        self.calculate_tour_cost(tour2))
-
-            new_tour1 = [child2 if c.id == child1.id else c for c in tour1]
-            new_tour2 = [child1 if c.id == child2.id else c for c in tour2]
-
-            new_tour1, _ = self.optimize_tour_order_2opt_list(new_tour1)
-            new_tour2, _ = self.optimize_tour_order_2opt_list(new_tour2)
-
-            new_cost = (self.calculate_tour_cost(new_tour1) +
-                        self.calculate_tour_cost(new_tour2))
-
-            delta = new_cost - old_cost
-
-            if delta < 0 or random.random() < np.exp(-delta / temp):
-                current_tours[tour1_id] = new_tour1
-                current_tours[tour2_id] = new_tour2
-                current_cost = current_cost - old_cost + new_cost
-
-                if delta < 0:
-                    swaps_performed.append({
-                        'iteration': iteration,
-                        'tour1_id': tour1_id,
-                        'tour2_id': tour2_id,
-                        'child1': f"{child1.forname} {child1.surname}",
-                        'child2': f"{child2.forname} {child2.surname}",
-                        'improvement': -delta
-                    })
-
-                if current_cost < best_cost:
-                    best_tours = deepcopy(current_tours)
-                    best_cost = current_cost
-
-            temp *= cooling_rate
-
-        total_improvement = sum(self.calculate_tour_cost(tour)
-                                for tour in self.tours.values()) - best_cost
-
-        return {
-            'total_improvement': total_improvement,
-            'optimized_tours': best_tours,
-            'swaps_performed': swaps_performed,
-            'iterations': max_iterations,
-            'final_cost': best_cost
-        }
-
-    def full_optimization(self, inter_tour_iterations=1000, status_text=None) -> Dict[str, any]:
-        """
-        Perform a full optimization in three steps:
-        1. Intra-Tour-Optimizing (Oder)
-        2. Inter-Tour-Optimizing (Swaps)
-        3. Another Intra-Tour-Optimizing
-        """
-        status_text.text("🔄 Starte die erste Intra-Tour-Optimierung...")
-        intra_result1 = self.optimize_all_tours_intra()
-
-        # Update tours mit optimierten Reihenfolgen
-        status_text.text(f"🔄 Ersparnisse nach der ersten Runde {round(intra_result1['total_improvement'], 2)} Meter")
-        self.tours = intra_result1['optimized_tours']
-
-        if len(self.tours) < 2:
-            return {
-                'total_improvement': intra_result1['total_improvement'],
-                'intra_optimization_1': intra_result1,
-                'inter_optimization': None,
-                'intra_optimization_2': None,
-                'final_tours': intra_result1['optimized_tours']
-            }
-
-        status_text.text("🔄 Starte die Inter-Tour-Optimierung...")
-        inter_result = self.optimize_inter_tour_swaps(
-            max_iterations=inter_tour_iterations,
-        )
-        status_text.text(f"🔄 Ersparnisse nach der Inter-Tour-Optimierung {round(inter_result['total_improvement'], 2)} Meter")
-        # Update tours mit Swap-Ergebnissen
-        self.tours = inter_result['optimized_tours']
-
-        status_text.text("🔄 Starte die zweite Intra-Tour-Optimierung...")
-        intra_result2 = self.optimize_all_tours_intra()
-
-        total_improvement = (intra_result1['total_improvement'] +
-                             inter_result['total_improvement'] +
-                             intra_result2['total_improvement'])
-
-        return {
-            'total_improvement': total_improvement,
-            'intra_optimization_1': intra_result1,
-            'inter_optimization': inter_result,
-            'intra_optimization_2': intra_result2,
-            'final_tours': intra_result2['optimized_tours']
-        }
+from src.optimizing.tour_optimizer import TourOptimizer
 
 class OptimizerModule:
+    STOP_KEY = "stop_optimization"  # set by the stop button of the UI
+    PARTIAL_KEY = "partial_optimization"  # best tours so far of a running optimization
+
     def __init__(self, config):
         self.config = config
 
@@ -333,7 +31,7 @@ class OptimizerModule:
         optimized_distances = {}
         for tour_id, tour in tour_dict.items():
             if len(tour) > 0:
-                distance = optimizer.calculate_tour_cost(tour)
+                distance = optimizer.calculate_tour_cost(tour, metric="distance")
                 optimized_distances[str(tour_id)] = logical_round(distance / 1000)
         return optimized_distances
 
@@ -366,30 +64,76 @@ class OptimizerModule:
         # First turn the tour data into a list of Child objects
         status_text.text("📊 Extrahiere die benötigten Datan aus den Touren...")
         osmr_url = os.getenv("OSMR_URL", None)
-        distance_matrix, school_indeces, children, school = OptimizingDataset.generate_optimizing_dataset(update_progress,
+        distance_matrix, school_indeces, stops, school = OptimizingDataset.generate_optimizing_dataset(update_progress,
                                                                                                           status_text,
                                                                                                           osmr_url)
-        if distance_matrix is None or school_indeces is None or children is None:
+        if distance_matrix is None or school_indeces is None or stops is None:
             st.error("Fehler beim Laden der Optimierungsdaten.")
             return None
         status_text.text("🚀 Starte die Optimierung der Touren...")
         optimizer = TourOptimizer(
-            distance_matrix=distance_matrix.to_numpy(), # Optimizer works with numpy arrays
-            children=children,
+            distance_matrix=distance_matrix.values, # Optimizer works with numpy arrays
+            children=stops,  # Co-located children of a tour are optimized as one stop
             school_positions=school_indeces,
-            max_capacity=self.config.get('max_capacity', 8)
+            node_index=distance_matrix.node_index,
+            max_capacity=self.config.get('max_capacity', 8),
+            duration_matrix=distance_matrix.metric("duration"),
+            metric=self.config.get('metric', 'distance'),
+            metric_weights=self.config.get('metric_weights'),
+            exact_max_size=self.config.get('exact_max_size', 9),
+            seed=self.config.get('seed'),
+            parallel_min_stops=int(os.getenv("OPTIMIZER_PARALLEL_MIN_STOPS", 500))
         )
+        # With a time budget the optimizer runs in anytime mode and shows its progress live
+        time_budget = self.config.get('time_budget')
+        st.session_state[self.STOP_KEY] = False
+        # Tours of an earlier, interrupted run must not be taken for this one
+        st.session_state[self.PARTIAL_KEY] = None
         result_dict = optimizer.full_optimization(
-            inter_tour_iterations=self.config.get('inter_tour_iterations', 10000),
-            status_text=status_text
+            inter_tour_iterations=self.config.get('inter_tour_iterations', None if time_budget else 10000),
+            status_text=status_text,
+            chains=self.config.get('chains', int(os.getenv("OPTIMIZER_CHAINS", 1))),
+            time_budget=time_budget,
+            plateau_iterations=self.config.get('plateau_iterations', 5000 if time_budget else None),
+            progress_callback=self.live_progress(optimizer, school, status_text) if time_budget else None
         )
+        st.session_state[self.PARTIAL_KEY] = None
 
         if result_dict is None:
             st.error("Fehler bei der Optimierung der Touren.")
             return {}
 
+        return self.finish(optimizer, school, result_dict['final_tours'], status_text)
+
+    def live_progress(self, optimizer: TourOptimizer, school, status_text):
+        """Progress callback drawing the best cost so far, the best tours are kept for stopping early."""
+        chart = st.empty()
+        history = []
+        cost_column = f"Kosten ({optimizer.cost_unit})"
+
+        def on_progress(stats):
+            # Stored first, clicking the stop button interrupts the script at the next streamlit call
+            st.session_state[self.PARTIAL_KEY] = {"optimizer": optimizer, "school": school,
+                                                  "final_tours": stats['best_tours']}
+            history.append({"Sekunden": round(stats['elapsed'], 1), cost_column: stats['best_cost']})
+            chart.line_chart(pd.DataFrame(history), x="Sekunden", y=cost_column)
+            status_text.text(f"🔄 Bisherige Ersparnis {logical_round(stats['improvement'])} {optimizer.cost_unit} "
+                             f"nach {round(stats['elapsed'])} Sekunden")
+        return on_progress
+
+    def finish_stopped(self):
+        """Finish a stopped optimization with the best tours found until then, None if there are none."""
+        partial = st.session_state.get(self.PARTIAL_KEY)
+        st.session_state[self.PARTIAL_KEY] = None
+        st.session_state[self.STOP_KEY] = False
+        if not partial:
+            return None
+        return self.finish(partial["optimizer"], partial["school"], partial["final_tours"], st.empty())
+
+    def finish(self, optimizer: TourOptimizer, school, final_tours, status_text):
+        """Turn the optimized stops into tour tables and compare them with the original tours."""
         status_text.text("Bringe die optimierten Touren in das korrekte Format...")
-        optimized_tour_dict = OptimizingDataset.turn_children_list_into_tour_dict(result_dict['final_tours'], school)
+        optimized_tour_dict = OptimizingDataset.turn_children_list_into_tour_dict(final_tours, school)
 
         # Save the optimized tour as session state with og tour information
         optimized_tour_dict = self.save_optimized_as_og(optimized_tour_dict)
@@ -403,11 +147,20 @@ class OptimizerModule:
             optimized_tour_dict
         )
 
-        optimized_distances = self.get_costs_for_tours(result_dict['final_tours'], optimizer)
-        osm_distances = self.get_costs_for_tours(optimizer.tours, optimizer)
+        optimized_distances = self.get_costs_for_tours(final_tours, optimizer)
+        # optimizer.tours holds the optimized tours, optimizer.original_tours the plan before the optimization
+        original_tours = optimizer.original_tours
+        osm_distances = self.get_costs_for_tours(original_tours, optimizer)
 
+        # Improvements are reported per metric, independent of the (possibly weighted) optimized cost
+        improvements = {
+            metric: sum(optimizer.calculate_tour_cost(tour, metric=metric) for tour in original_tours.values()) -
+                    sum(optimizer.calculate_tour_cost(tour, metric=metric) for tour in final_tours.values())
+            for metric in ("distance", "duration")
+        }
         optimization_dict = {
-            "total_improvement": {"value": logical_round(result_dict['total_improvement']), "name": "Gesamte Verbesserung (Distanz in Metern)"},
+            "total_improvement": {"value": logical_round(improvements["distance"]), "name": "Gesamte Verbesserung (Distanz in Metern)"},
+            "duration_improvement": {"value": f"{logical_round(improvements['duration'] / 60)} min", "name": "Gesamte Verbesserung (Fahrzeit)"},
         }
         status_text.text("✅ Optimierung abgeschlossen!")
 
@@ -0,0 +1,100 @@
+from threading import Lock
+from typing import List, Tuple
+import logging
+import os
+import sqlite3
+import numpy as np
+
+
+class DistanceCache:
+    """Persistent cache of OSRM distances and durations keyed by rounded (lat, lon) origin/destination pairs and profile.
+
+    The cache lives in a local SQLite file, so it is shared by all sessions and survives restarts
+    and new uploads of the same tour plan.
+    """
+    def __init__(self, path: str, precision: int = 5):
+        self.path = path
+        # 5 decimals are ~1m, so geocoding the same address twice always hits the same key
+        self.scale = 10 ** precision
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS distances (
+                    profile TEXT NOT NULL,
+                    src_lat INTEGER NOT NULL,
+                    src_lon INTEGER NOT NULL,
+                    dst_lat INTEGER NOT NULL,
+                    dst_lon INTEGER NOT NULL,
+                    distance REAL NOT NULL,
+                    duration REAL,
+                    PRIMARY KEY (profile, src_lat, src_lon, dst_lat, dst_lon)
+                ) WITHOUT ROWID
+            """)
+            # Caches created before durations were stored get the column added, their rows count as misses
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(distances)")]
+            if "duration" not in columns:
+                self.connection.execute("ALTER TABLE distances ADD COLUMN duration REAL")
+
+    def _keys(self, points: List[Tuple[float, float]]) -> List[Tuple[int, int]]:
+        return [(int(round(lat * self.scale)), int(round(lon * self.scale))) for lat, lon in points]
+
+    def lookup_matrix(self, points: List[Tuple[float, float]], profile: str) -> np.ndarray:
+        """Return the cached 2 x n x n (distance, duration) matrix for all (lat, lon) points, missing pairs are NaN."""
+        matrix = np.full((2, len(points), len(points)), np.nan)
+        if not points:
+            return matrix
+        rows = [(idx, lat, lon) for idx, (lat, lon) in enumerate(self._keys(points))]
+        with self.lock:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_points (idx INTEGER, lat INTEGER, lon INTEGER)")
+            self.connection.execute("DELETE FROM lookup_points")
+            self.connection.executemany("INSERT INTO lookup_points VALUES (?, ?, ?)", rows)
+            cached = self.connection.execute("""
+                SELECT s.idx, d.idx, c.distance, c.duration
+                FROM lookup_points s
+                JOIN lookup_points d
+                JOIN distances c
+                  ON c.profile = ? AND c.src_lat = s.lat AND c.src_lon = s.lon
+                 AND c.dst_lat = d.lat AND c.dst_lon = d.lon
+               WHERE c.duration IS NOT NULL
+            """, (profile,)).fetchall()
+            self.connection.rollback()
+        if cached:
+            cached = np.array(cached)
+            rows, columns = cached[:, 0].astype(int), cached[:, 1].astype(int)
+            matrix[0, rows, columns] = cached[:, 2]
+            matrix[1, rows, columns] = cached[:, 3]
+        return matrix
+
+    def store_block(self, points: List[Tuple[float, float]], sources: List[int], destinations: List[int],
+                    block: np.ndarray, profile: str):
+        """Store a 2 x sources x destinations (distance, duration) block, unreachable (inf) pairs are not cached."""
+        # Only the points of the block are keyed, other points may not be geocoded
+        used = sorted(set(sources) | set(destinations))
+        keys = dict(zip(used, self._keys([points[i] for i in used])))
+        rows = [(profile, *keys[s], *keys[d], float(block[0, i, j]), float(block[1, i, j]))
+                for i, s in enumerate(sources) for j, d in enumerate(destinations)
+                if np.isfinite(block[:, i, j]).all()]
+        with self.lock, self.connection:
+            self.connection.executemany("""
+                INSERT OR REPLACE INTO distances (profile, src_lat, src_lon, dst_lat, dst_lon, distance, duration)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_distance_cache() -> DistanceCache:
+    """Return the process wide distance cache, None if it can't be opened."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = DistanceCache(os.getenv("DISTANCE_CACHE_PATH", "./distance_cache.sqlite"))
+            except sqlite3.Error as e:
+                logging.error(f"Could not open the distance cache: {e}")
+                return None
+        return _cache
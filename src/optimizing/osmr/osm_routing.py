@@ -1,19 +1,39 @@
-from typing import List, Tuple, Callable
+from typing import Dict, List, Tuple, Callable
+from concurrent.futures import as_completed
 import requests
 import logging
 import streamlit as st
-import pandas as pd
+import numpy as np
 import os
 from src.optimizing.child import Child, School
+from src.optimizing.distance_matrix import DistanceMatrix, haversine_matrix
+from src.optimizing.osmr.osrm_client import get_osrm_client
+from src.optimizing.osmr.osrm_health import get_osrm_health
+from src.optimizing.osmr.distance_cache import get_distance_cache
 
 
 class OSMR_Module:
     """This module contains the functions to interact with the local OSMR instance"""
-    def __init__(self, maps: bool = False, osmr_url: str = "http://127.0.0.1:5001/route/v1/driving/{},{};{},{}?steps=true"):
+    def __init__(self, maps: bool = False, osmr_url: str = "http://127.0.0.1:5001/route/v1/driving/{},{};{},{}?steps=true",
+                 table_url: str = "http://127.0.0.1:5001/table/v1/driving/", max_table_size: int = 100,
+                 matrix_mode: str = "auto", sparse_threshold: int = 300, sparse_neighbours: int = 12):
         if maps:
             self.osmr_url = os.getenv("OSMR_MAPS_URL", osmr_url)
         else:
             self.osmr_url = os.getenv("OSMR_URL", osmr_url)
+        self.table_url = os.getenv("OSMR_TABLE_URL", table_url)
+        # Routing profile (e.g. driving) is part of the distance cache key
+        self.profile = self.table_url.rstrip("/").split("/")[-1]
+        # Has to match the --max-table-size of osrm-routed (OSRM default: 100)
+        self.max_table_size = int(os.getenv("OSMR_MAX_TABLE_SIZE", max_table_size))
+        # dense: route every pair, sparse: route only the k nearest neighbours and school legs,
+        # auto: sparse once the matrix has more than sparse_threshold nodes
+        self.matrix_mode = os.getenv("OSMR_MATRIX_MODE", matrix_mode)
+        self.sparse_threshold = int(os.getenv("OSMR_SPARSE_THRESHOLD", sparse_threshold))
+        self.sparse_neighbours = int(os.getenv("OSMR_SPARSE_NEIGHBOURS", sparse_neighbours))
+        self.client = get_osrm_client()
+        self.health = get_osrm_health(self.osmr_url)
+        self.cache_stats = {"hits": 0, "misses": 0, "estimated": 0}
 
 
     def _ensure_lonlat(self, point: Tuple[float, float]) -> Tuple[float, float]:
@@ -22,12 +42,15 @@ class OSMR_Module:
         return (lon, lat)
 
 
-    def is_osmr_url_reachable(self, base_url: str = None) -> bool:
-        """Check if the OSMR URL is reachable."""
+    def _probe_url(self) -> str:
+        """Build a cheap route request used to probe the OSMR instance."""
+        if "{}" in self.osmr_url:
+            return self.osmr_url.format(10, 20, 10, 20)
+        return f"{self.osmr_url}10,20;10,20"
+
+    def _probe(self, base_url: str) -> bool:
         try:
-            if not base_url:
-                base_url = self.osmr_url.format(10, 20, 10, 20)
-            response = requests.get(base_url, timeout=5)
+            response = self.client.get(base_url, timeout=5)
             if response.status_code == 200:
                 return True
             else:
@@ -38,6 +61,19 @@ class OSMR_Module:
             logging.error(f"Error reaching OSMR URL: {e}")
             return False
 
+    def is_osmr_url_reachable(self, base_url: str = None) -> bool:
+        """Check if the OSMR URL is reachable, the result is cached by the shared health state."""
+        if not base_url:
+            base_url = self._probe_url()
+        return self.health.is_available(lambda: self._probe(base_url))
+
+    def _record_response(self, response: requests.Response):
+        """Feed the outcome of a request into the circuit breaker, OSRM answers 4xx for unroutable input."""
+        if response.status_code >= 500:
+            self.health.record_failure()
+        else:
+            self.health.record_success()
+
     def calculate_distance(self, child1: Tuple[float, float], child2: Tuple[float, float]) -> float:
         """Calculate distance between two points using OSRM."""
         if not self.is_osmr_url_reachable():
@@ -50,7 +86,8 @@ class OSMR_Module:
         url = self.osmr_url.format(*c1, *c2)
 
         try:
-            response = requests.get(url, timeout=10)
+            response = self.client.get(url, timeout=10)
+            self._record_response(response)
             response.raise_for_status()
             data = response.json()
 
@@ -59,6 +96,11 @@ class OSMR_Module:
             else:
                 logging.error(f"Invalid OSRM response: {data}")
                 return float('inf')
+        except requests.RequestException as e:
+            if e.response is None:
+                self.health.record_failure()
+            logging.error(f"Error calculating distance: {e}")
+            return float('inf')
         except Exception as e:
             logging.error(f"Error calculating distance: {e}")
             return float('inf')
@@ -67,54 +109,266 @@ class OSMR_Module:
         """Call the osmr module using defined params"""
         url = f"{self.osmr_url}{coordinates_str}"
         logging.info(f"OSMR Request URL: {url} with params: {params}")
-        if not self.is_osmr_url_reachable(base_url=url):
+        if not self.is_osmr_url_reachable():
             st.sidebar.error("OSMR URL is not reachable. Please check the OSMR instance.")
             return None
-        response = requests.get(url, params=params, timeout=30)
+        try:
+            response = self.client.get(url, params=params, timeout=30)
+        except requests.RequestException:
+            self.health.record_failure()
+            raise
+        self._record_response(response)
         response.raise_for_status()
         return response.json()
 
 
 
-    def create_distance_matrix_from_osmr(self, children_list: List[Child], school_element: School, update_progress: Callable) -> pd.DataFrame:
-        """Create a distance matrix from the OSMR instance."""
-        if not self.is_osmr_url_reachable():
-            st.sidebar.error("OSMR URL is not reachable. Please check the OSMR instance.")
-            return None
+    def request_table(self, coordinates: List[Tuple[float, float]], sources: List[int],
+                      destinations: List[int]) -> np.ndarray:
+        """Request a sources x destinations block of distances and durations from the OSRM /table service.
+
+        Args:
+            coordinates: (lat, lon) points sent with the request
+            sources: indices into coordinates used as origins
+            destinations: indices into coordinates used as targets
+
+        Returns:
+            2 x len(sources) x len(destinations) array with the distances in meters and the
+            durations in seconds, unreachable pairs are inf, the whole block is NaN if the request failed
+        """
+        coordinates_str = ";".join(f"{lon},{lat}" for lon, lat in map(self._ensure_lonlat, coordinates))
+        params = {
+            "sources": ";".join(map(str, sources)),
+            "destinations": ";".join(map(str, destinations)),
+            "annotations": "distance,duration",
+        }
+        if not self.health.allows_requests():
+            # Fail fast while the circuit is open instead of waiting for the timeout of every block
+            return np.full((2, len(sources), len(destinations)), np.nan)
+        try:
+            response = self.client.get(f"{self.table_url}{coordinates_str}", params=params, timeout=30)
+            self._record_response(response)
+            response.raise_for_status()
+            data = response.json()
+
+            if data.get("code") == "Ok":
+                return np.array([[[np.inf if value is None else value for value in row] for row in data[annotation]]
+                                 for annotation in ("distances", "durations")], dtype=float)
+            else:
+                logging.error(f"Invalid OSRM table response: {data.get('code')} - {data.get('message')}")
+        except requests.RequestException as e:
+            if e.response is None:
+                self.health.record_failure()
+            logging.error(f"Error requesting OSRM table: {e}")
+        except Exception as e:
+            logging.error(f"Error requesting OSRM table: {e}")
+        # Failed blocks stay unknown, only pairs OSRM answered with null are unreachable (inf)
+        return np.full((2, len(sources), len(destinations)), np.nan)
+
+    def _grid(self, rows: np.ndarray, columns: np.ndarray) -> List[Tuple[List[int], List[int]]]:
+        """Split rows x columns into blocks of at most max_table_size sources and destinations."""
+        return [(rows[row_start:row_start + self.max_table_size].tolist(),
+                 columns[column_start:column_start + self.max_table_size].tolist())
+                for row_start in range(0, len(rows), self.max_table_size)
+                for column_start in range(0, len(columns), self.max_table_size)]
+
+    def _table_blocks(self, missing: np.ndarray, full_share: float = 0.5) -> List[Tuple[List[int], List[int]]]:
+        """Split the missing entries into sources x destinations blocks of at most max_table_size.
+
+        Added or moved nodes miss (almost) their whole row and column. Their rows are requested as
+        1 x N blocks and their columns as N x 1 blocks, the known rest of the matrix is not routed again.
+        """
+        missing = missing.copy()
+        blocks = []
+        full_rows = np.flatnonzero(missing.mean(axis=1) >= full_share)
+        if len(full_rows):
+            blocks += self._grid(full_rows, np.flatnonzero(missing[full_rows].any(axis=0)))
+            missing[full_rows] = False
+        full_columns = np.flatnonzero(missing.mean(axis=0) >= full_share)
+        if len(full_columns):
+            blocks += self._grid(np.flatnonzero(missing[:, full_columns].any(axis=1)), full_columns)
+            missing[:, full_columns] = False
+
+        rows = np.flatnonzero(missing.any(axis=1))
+        # Rows with many missing entries are grouped, so they share their blocks
+        rows = rows[np.argsort(-missing[rows].sum(axis=1), kind="stable")]
+        for start in range(0, len(rows), self.max_table_size):
+            source_block = rows[start:start + self.max_table_size]
+            columns = np.flatnonzero(missing[source_block].any(axis=0))
+            if missing[np.ix_(source_block, columns)].mean() < 0.25:
+                # Sparse pattern (e.g. nearest neighbours), a request per row avoids routing unneeded pairs
+                for row in source_block:
+                    blocks += self._grid(np.array([row]), np.flatnonzero(missing[row]))
+                continue
+            blocks += self._grid(source_block, columns)
+        return blocks
+
+    def _sparse_pairs(self, distances: np.ndarray, anchors: List[int]) -> np.ndarray:
+        """Pairs which are routed in sparse mode: the k nearest neighbours of every node in both
+        directions and all legs from and to the anchors (schools)."""
+        size = len(distances)
+        k = min(self.sparse_neighbours, size - 1)
+        required = np.zeros((size, size), dtype=bool)
+        if k > 0:
+            neighbour_distances = distances + np.diag(np.full(size, np.inf))
+            neighbours = np.argpartition(neighbour_distances, k - 1, axis=1)[:, :k]
+            required[np.repeat(np.arange(size), k), neighbours.ravel()] = True
+        required |= required.T
+        required[anchors, :] = True
+        required[:, anchors] = True
+        return required
+
+    @staticmethod
+    def _estimate_missing(matrices: np.ndarray, distances: np.ndarray) -> int:
+        """Fill the remaining unknown pairs with haversine distances scaled by the detour factor and the
+        average speed observed on the routed pairs. Returns the number of estimated pairs."""
+        missing = np.isnan(matrices).any(axis=0)
+        known = ~missing & np.isfinite(matrices).all(axis=0) & (distances > 0) & (matrices[1] > 0)
+        detour_factor = np.median(matrices[0][known] / distances[known]) if known.any() else 1.3
+        speed = np.median(matrices[0][known] / matrices[1][known]) if known.any() else 30 / 3.6  # m/s
+        matrices[0][missing] = distances[missing] * detour_factor
+        matrices[1][missing] = matrices[0][missing] / speed
+        return int(missing.sum())
+
+    def fill_missing_distances(self, points: List[Tuple[float, float]], matrices: np.ndarray,
+                               update_progress: Callable = None, required: np.ndarray = None) -> dict:
+        """Fill all unknown pairs of the distance and duration matrix, first from the distance cache then from OSRM.
+
+        Both metrics are requested in the same pass, a pair is unknown as long as one of them is NaN.
+
+        Args:
+            points: (lat, lon) of every row/column of the matrix
+            matrices: 2 x n x n array (distance, duration), filled in place
+            update_progress: called with (completed pairs, total pairs) per received block
+            required: optional n x n mask, only these pairs are requested from OSRM if they are not cached
+
+        Returns:
+            dict with the number of cache hits and misses
+        """
+        # Children which could not be geocoded keep their node but can't be routed
+        located = np.array([lat is not None and lon is not None for lat, lon in points], dtype=bool)
+        matrices[:, ~located, :] = np.inf
+        matrices[:, :, ~located] = np.inf
+        for matrix in matrices:
+            np.fill_diagonal(matrix, 0)  # Distance to self is 0
+        missing = np.isnan(matrices).any(axis=0)
+        cache = get_distance_cache()
+        hits = 0
+        if cache is not None and missing.any():
+            located_indices = np.flatnonzero(located)
+            cached = np.full(matrices.shape, np.nan)
+            cached[np.ix_(range(len(matrices)), located_indices, located_indices)] = cache.lookup_matrix(
+                [points[i] for i in located_indices], self.profile)
+            found = missing & ~np.isnan(cached).any(axis=0)
+            matrices[:, found] = cached[:, found]
+            hits = int(found.sum())
+            missing = np.isnan(matrices).any(axis=0)
+        if required is not None:
+            missing &= required
+
+        requests_by_block = {}
+        for source_block, destination_block in self._table_blocks(missing):
+            # Points which are source and destination at the same time are only sent once
+            block_points = list(dict.fromkeys(source_block + destination_block))
+            position = {point: k for k, point in enumerate(block_points)}
+            future = self.client.submit(self.request_table, [points[i] for i in block_points],
+                                        [position[i] for i in source_block], [position[i] for i in destination_block])
+            requests_by_block[future] = (source_block, destination_block)
+
+        # Blocks are requested concurrently, progress is reported from this thread as they arrive
+        total = missing.size
+        count = total - int(missing.sum())
+        for future in as_completed(requests_by_block):
+            source_block, destination_block = requests_by_block[future]
+            block = future.result()
+            block_index = np.ix_(range(len(matrices)), source_block, destination_block)
+            block_missing = missing[np.ix_(source_block, destination_block)]
+            count += int(block_missing.sum())
+            matrices[block_index] = np.where(block_missing, block, matrices[block_index])
+            if cache is not None:
+                cache.store_block(points, source_block, destination_block, block, self.profile)
 
-        # Initialize the distance matrix
-        matrix_size = len(children_list) + 1  # +1 for the school
-        distance_matrix = pd.DataFrame(index=range(matrix_size), columns=range(matrix_size))
-
-        # Fill the distance matrix
-        count = 0
-        for i, child1 in enumerate(children_list):
-            st.session_state["children_to_index"][child1.id] = i
-            for j, child2 in enumerate(children_list):
-                count += 1
-                if i == j:
-                    distance_matrix.iloc[i, j] = 0  # Distance to self is 0
-                else:
-                    distance_matrix.iloc[i, j] = self.calculate_distance((child1.lat, child1.lon), (child2.lat, child2.lon))
-                # Update Progress
-                if update_progress:
-                    update_progress(count, matrix_size ** 2)
-
-
-            # Distance between child and school
-            distance_matrix.iloc[i, len(children_list)] = self.calculate_distance((child1.lat, child1.lon), (school_element.lat,
-                                                                             school_element.lon))
-
-        # Distance between school and all children
-        for j, child in enumerate(children_list):
-            count += 1
-            distance_matrix.iloc[len(children_list), j] = self.calculate_distance((school_element.lat, school_element.lon),
-                                                                             (child.lat, child.lon))
             # Update Progress
             if update_progress:
-                update_progress(count, matrix_size ** 2)
+                update_progress(count, total)
+
+        stats = {"hits": hits, "misses": int(missing.sum()), "estimated": 0,
+                 "failed": int((missing & np.isnan(matrices).any(axis=0)).sum())}
+        logging.info(f"Distance cache: {stats['hits']} hits, {stats['misses']} misses")
+        return stats
+
+    def update_distance_matrix(self, distance_matrix: DistanceMatrix, nodes: Dict[str, Tuple[float, float]],
+                               update_progress: Callable, anchors: List[str] = None) -> DistanceMatrix:
+        """Bring the distance matrix in line with the given nodes and request only the unknown entries.
+
+        Added or moved nodes cost one new row and column, dropped nodes cost nothing. In sparse mode only
+        the nearest neighbours of every node and the legs from and to the anchors are routed, all other
+        pairs are estimated from the haversine distance.
+
+        Args:
+            distance_matrix: matrix to update in place
+            nodes: node_id -> (lat, lon) of all children and schools
+            update_progress: called with (completed entries, total entries) per received block
+            anchors: node_ids which are always routed exactly in sparse mode (schools)
+        """
+        changes = distance_matrix.sync(nodes)
+        changes["retried"] = distance_matrix.forget_failed()
+
+        active = distance_matrix.active_indices()
+        points = distance_matrix.active_points()
+        sparse = self.matrix_mode == "sparse" or (self.matrix_mode == "auto" and len(active) > self.sparse_threshold)
+        if sparse:
+            air_distances = np.nan_to_num(haversine_matrix(points), nan=np.inf)
+            anchor_positions = [active.index(distance_matrix.index_of(node_id)) for node_id in anchors or []]
+            required = self._sparse_pairs(air_distances, anchor_positions)
+        else:
+            required = np.ones((len(active), len(active)), dtype=bool)
+        # Pairs an earlier sparse update only estimated are routed once they are required
+        changes["unestimated"] = distance_matrix.forget_estimated(active, required)
+        logging.info(f"Distance matrix update: {changes}")
+        if distance_matrix.free:
+            matrices = distance_matrix.stacked[np.ix_(range(len(distance_matrix.METRICS)), active, active)]
+        else:
+            # Without dropped nodes the matrix is filled in place
+            matrices = distance_matrix.stacked
+        if np.isnan(matrices).any():
+            if not self.is_osmr_url_reachable():
+                st.sidebar.error("OSMR URL is not reachable. Please check the OSMR instance.")
+                return None
+            if sparse:
+                self.cache_stats = self.fill_missing_distances(points, matrices, update_progress, required)
+                estimated = np.isnan(matrices).any(axis=0)
+                failed = estimated & required
+                self.cache_stats["estimated"] = self._estimate_missing(matrices, air_distances)
+                distance_matrix.mark_estimated(active, estimated & ~required)
+                logging.info(f"Sparse distance matrix: {self.cache_stats['estimated']} pairs estimated")
+            else:
+                self.cache_stats = self.fill_missing_distances(points, matrices, update_progress)
+                failed = np.isnan(matrices).any(axis=0)
+                if failed.any():
+                    self.cache_stats["estimated"] = self._estimate_missing(matrices, np.nan_to_num(
+                        haversine_matrix(points), nan=np.inf))
+            if self.health.is_open():
+                st.sidebar.error("OSMR instance stopped answering while creating the distance matrix.")
+                return None
+            if failed.any():
+                # Estimated for now, requested again on the next update
+                logging.warning(f"OSRM failed for {int(failed.sum())} pairs, they are estimated")
+                distance_matrix.mark_failed(active, failed)
+            if distance_matrix.free:
+                distance_matrix.stacked[np.ix_(range(len(distance_matrix.METRICS)), active, active)] = matrices
+        elif update_progress:
+            update_progress(len(active) ** 2, len(active) ** 2)
+
+        return distance_matrix
 
-        # Distance from school to itself is 0
-        distance_matrix.iloc[len(children_list), len(children_list)] = 0
+    def create_distance_matrix_from_osmr(self, children_list: List[Child], school_element: School,
+                                         update_progress: Callable) -> DistanceMatrix:
+        """Create a distance and duration matrix for all children and the school from the distance cache and OSRM.
 
-        return distance_matrix
\ No newline at end of file
+        Only pairs which are not cached yet are requested from the /table service, in blocks of at
+        most max_table_size sources x destinations.
+        """
+        nodes = {child.id: (child.lat, child.lon) for child in children_list}
+        nodes[school_element.id] = (school_element.lat, school_element.lon)
+        return self.update_distance_matrix(DistanceMatrix(), nodes, update_progress, anchors=[school_element.id])
@@ -0,0 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from typing import Callable
+import os
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class OSRMClient:
+    """Pooled HTTP client for the OSRM instance with a bounded number of in-flight requests"""
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max_workers
+        # Keep-alive connections are reused for every request against the same host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="osrm")
+
+    def get(self, url: str, params: dict = None, timeout: float = 10) -> requests.Response:
+        """Send a GET request over the pooled session."""
+        return self.session.get(url, params=params, timeout=timeout)
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """Run func in the client's worker pool."""
+        return self.executor.submit(func, *args, **kwargs)
+
+
+_client = None
+_client_lock = Lock()
+
+
+def get_osrm_client() -> OSRMClient:
+    """Return the process wide OSRM client, shared by all sessions."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OSRMClient(max_workers=int(os.getenv("OSMR_MAX_WORKERS", 8)))
+        return _client
@@ -0,0 +1,125 @@
+from threading import Lock
+from typing import Callable, Dict
+from urllib.parse import urlsplit
+import logging
+import os
+import time
+
+
+class OSRMHealth:
+    """Cached health state of an OSRM instance with a circuit breaker.
+
+    The instance is probed at most once per ttl seconds. After failure_threshold
+    consecutive failures the circuit opens and all requests fail fast until the
+    cooldown has passed, then a single probe or request decides whether it closes again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, ttl: float = 30, failure_threshold: int = 3, cooldown: float = 60):
+        self.ttl = ttl
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.last_probe_time = None
+        self.last_probe_result = False
+        self.opened_at = None
+        self.lock = Lock()
+
+    def is_available(self, probe: Callable[[], bool]) -> bool:
+        """Return the cached health state, probe only if it has expired."""
+        with self.lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.cooldown:
+                    return False
+                self.state = self.HALF_OPEN
+            elif self.last_probe_time is not None and now - self.last_probe_time < self.ttl:
+                return self.last_probe_result
+
+            # Probe while holding the lock, concurrent callers wait for the result instead of probing too
+            result = probe()
+            self.last_probe_time = time.monotonic()
+            self.last_probe_result = result
+            self._register(result)
+            return result
+
+    def record_success(self):
+        """Register a successful request against the instance."""
+        with self.lock:
+            self._register(True)
+
+    def record_failure(self):
+        """Register a failed request against the instance."""
+        with self.lock:
+            self._register(False)
+
+    def allows_requests(self) -> bool:
+        """Check whether the circuit lets a request through without probing.
+
+        Once the cooldown of an open circuit has passed, exactly one request is let through (half open),
+        its recorded outcome closes or reopens the circuit. A request which never reports back is
+        replaced by the next one after another cooldown.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.cooldown:
+                return False
+            self.state = self.HALF_OPEN
+            self.opened_at = now
+            return True
+
+    def is_open(self) -> bool:
+        """Check whether the circuit blocks requests, without using up the half open request."""
+        with self.lock:
+            return self.state != self.CLOSED and time.monotonic() - self.opened_at < self.cooldown
+
+    def _register(self, success: bool):
+        if success:
+            self.consecutive_failures = 0
+            self.last_probe_result = True
+            self.state = self.CLOSED
+            return
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logging.error(f"OSRM circuit opened after {self.consecutive_failures} consecutive failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.last_probe_result = False
+
+    def status(self) -> Dict[str, any]:
+        """Return the current state for displaying it in the UI."""
+        with self.lock:
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+            return {
+                "state": self.state,
+                "available": self.state != self.OPEN and self.last_probe_result,
+                "consecutive_failures": self.consecutive_failures,
+                "checked": self.last_probe_time is not None,
+                "retry_in": retry_in,
+            }
+
+
+_health_by_host = {}
+_health_lock = Lock()
+
+
+def get_osrm_health(url: str) -> OSRMHealth:
+    """Return the process wide health state of the OSRM instance serving the url."""
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    with _health_lock:
+        if host not in _health_by_host:
+            _health_by_host[host] = OSRMHealth(
+                ttl=float(os.getenv("OSMR_HEALTH_TTL", 30)),
+                failure_threshold=int(os.getenv("OSMR_FAILURE_THRESHOLD", 3)),
+                cooldown=float(os.getenv("OSMR_CIRCUIT_COOLDOWN", 60)),
+            )
+        return _health_by_host[host]
@@ -0,0 +1,216 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from multiprocessing.managers import SyncManager
+from queue import Empty
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+import logging
+import os
+import time
+import numpy as np
+
+# (shared memory name, shape, dtype) of a matrix in shared memory
+MatrixSpec = Tuple[str, Tuple[int, ...], str]
+
+
+class SharedMatrix:
+    """Copy of a matrix in shared memory, worker processes attach it instead of receiving a pickled copy"""
+    def __init__(self, matrix: np.ndarray):
+        matrix = np.ascontiguousarray(matrix)
+        self.shm = SharedMemory(create=True, size=max(1, matrix.nbytes))
+        self.shape = matrix.shape
+        self.dtype = matrix.dtype
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)[...] = matrix
+
+    @property
+    def spec(self) -> MatrixSpec:
+        return self.shm.name, self.shape, self.dtype.str
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_pool = None
+_pool_lock = Lock()
+_manager = None
+
+
+def pool_size() -> int:
+    """Number of worker processes of the optimizer pool."""
+    return max(1, int(os.getenv("OPTIMIZER_MAX_WORKERS", os.cpu_count() or 1)))
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Return the process wide optimizer pool, the workers are started once and reused by every run."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, forking the threaded streamlit server is not safe
+            _pool = ProcessPoolExecutor(max_workers=pool_size(), mp_context=get_context("spawn"))
+        return _pool
+
+
+def get_manager() -> SyncManager:
+    """Return the process wide manager of the queues and events shared with running chains."""
+    global _manager
+    with _pool_lock:
+        if _manager is None:
+            _manager = get_context("spawn").Manager()
+        return _manager
+
+
+def _run_on_shared(spec: MatrixSpec, problem: Dict[str, any], work: Callable, **kwargs):
+    """Call work with a TourOptimizer of the worker on the shared cost matrix."""
+    # Imported here, the worker module must not depend on the optimizer at import time
+    from src.optimizing.tour_optimizer import TourOptimizer
+
+    name, shape, dtype = spec
+    shm = SharedMemory(name=name)
+    try:
+        # The optimizer only lives during the call, no view on the buffer is left when it is closed
+        return work(TourOptimizer(np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf), **problem, **kwargs))
+    finally:
+        shm.close()
+
+
+def run_chain(spec: MatrixSpec, problem: Dict[str, any], tours: Dict[int, np.ndarray], max_iterations: int,
+              temperature: float, cooling_rate: float, seed: int, limits: Dict[str, any],
+              control: Optional[Tuple[any, any]] = None) -> Dict[str, any]:
+    """Run a single seeded annealing chain in a worker process.
+
+    Args:
+        limits: 'deadline' (time.time() of the end of the budget) and 'plateau_iterations'
+        control: (queue, event) of the manager, the chain puts its progress into the queue and stops
+            once the event is set
+    """
+    queue, stop = control or (None, None)
+    deadline = limits.get('deadline')
+    # The budget runs from the start of the whole search, chains which waited in the pool get the rest
+    time_budget = None if deadline is None else max(0.0, deadline - time.time())
+    if stop is not None and stop.is_set():
+        time_budget = 0.0
+
+    def progress(stats: Dict[str, any]):
+        stats['seed'] = seed
+        queue.put(stats)
+
+    result = _run_on_shared(spec, problem, lambda optimizer: optimizer._inter_tour_search(
+        tours, max_iterations, temperature, cooling_rate, show_progress=False, time_budget=time_budget,
+        plateau_iterations=limits.get('plateau_iterations'), progress=progress if queue is not None else None,
+        should_stop=stop.is_set if stop is not None else None), seed=seed)
+    result['seed'] = seed
+    return result
+
+
+def run_intra(spec: MatrixSpec, problem: Dict[str, any], tours: Dict[int, np.ndarray]) -> Dict[str, any]:
+    """Optimize the order of a chunk of tours in a worker process."""
+    return _run_on_shared(spec, problem, lambda optimizer: optimizer._optimize_intra_sequential(tours))
+
+
+def run_multi_start(matrix: np.ndarray, problem: Dict[str, any], tours: Dict[int, np.ndarray], seeds: List[int],
+                    max_iterations: int, temperature: float, cooling_rate: float, time_budget: float = None,
+                    plateau_iterations: int = None, progress: Callable[[Dict[str, any]], None] = None,
+                    should_stop: Callable[[], bool] = None, progress_interval: float = 0.5) -> Dict[str, any]:
+    """Run one annealing chain per seed in the process pool and return the best result.
+
+    Args:
+        matrix: cost matrix, shared with the workers through shared memory
+        problem: keyword arguments of the TourOptimizer in the workers (children, school_positions, ...)
+        tours: start solution, shared by all chains
+        time_budget: seconds for all chains together, counted from now, also for chains waiting in the pool
+        plateau_iterations: stop criterion of every chain, see TourOptimizer._inter_tour_search
+        progress: gets the best progress of all chains, see TourOptimizer._inter_tour_search
+        should_stop: checked every progress_interval seconds, stops all chains once it returns True
+
+    Returns:
+        result of the best chain with the statistics of all chains under 'chains'
+    """
+    start = time.perf_counter()
+    limits = {'deadline': None if time_budget is None else time.time() + time_budget,
+              'plateau_iterations': plateau_iterations}
+    control = None
+    if progress is not None or should_stop is not None:
+        manager = get_manager()
+        control = (manager.Queue(), manager.Event())
+    with SharedMatrix(matrix) as shared:
+        futures = [get_process_pool().submit(run_chain, shared.spec, problem, tours, max_iterations, temperature,
+                                             cooling_rate, seed, limits, control) for seed in seeds]
+        try:
+            if control is not None:
+                _follow_chains(futures, control, progress, should_stop, progress_interval)
+            results = [future.result() for future in futures]
+        finally:
+            # Also when the caller is interrupted (e.g. a streamlit rerun), no chain keeps running
+            if control is not None:
+                control[1].set()
+            for future in futures:
+                future.cancel()
+    logging.info(f"Ran {len(seeds)} annealing chains on {pool_size()} processes in {time.perf_counter() - start:.2f}s")
+
+    # Ties go to the lower chain, so a seeded run always picks the same result
+    best = min(range(len(results)), key=lambda k: (results[k]['final_cost'], k))
+    result = dict(results[best])
+    result['best_chain'] = best
+    result['chains'] = [{
+        'seed': chain['seed'],
+        'final_cost': chain['final_cost'],
+        'total_improvement': chain['total_improvement'],
+        'moves_evaluated': chain['moves_evaluated'],
+        'moves_accepted': chain['moves_accepted'],
+        'iterations': chain['iterations'],
+        'stop_reason': chain['stop_reason'],
+        'runtime': chain['runtime'],
+    } for chain in results]
+    return result
+
+
+def _follow_chains(futures: List, control: Tuple[any, any], progress: Callable[[Dict[str, any]], None],
+                   should_stop: Callable[[], bool], progress_interval: float):
+    """Report the best progress of the running chains and stop them on request, until all are done."""
+    queue, stop = control
+    latest = {}
+    pending = set(futures)
+    while pending:
+        _, pending = wait(pending, timeout=progress_interval, return_when=FIRST_COMPLETED)
+        try:
+            while True:
+                stats = queue.get_nowait()
+                latest[stats['seed']] = stats
+        except Empty:
+            pass
+        if progress is not None and latest:
+            best = dict(min(latest.values(), key=lambda stats: stats['best_cost']))
+            best['iteration'] = sum(stats['iteration'] for stats in latest.values())
+            progress(best)
+        if should_stop is not None and not stop.is_set() and should_stop():
+            stop.set()
+
+
+def run_parallel_intra(matrix: np.ndarray, problem: Dict[str, any], tours: Dict[int, np.ndarray]) -> Dict[str, any]:
+    """Optimize the order of all tours in the process pool.
+
+    The tours are split into contiguous chunks and merged in their original order, so the result
+    (and its 'details') is the same as the one of a single process run.
+    """
+    tour_ids = list(tours.keys())
+    n_chunks = min(len(tour_ids), 4 * pool_size())
+    chunks = [chunk for chunk in np.array_split(np.arange(len(tour_ids)), n_chunks) if len(chunk)]
+    with SharedMatrix(matrix) as shared:
+        futures = [get_process_pool().submit(run_intra, shared.spec, problem,
+                                             {tour_ids[k]: tours[tour_ids[k]] for k in chunk}) for chunk in chunks]
+        results = [future.result() for future in futures]
+
+    merged = {'total_improvement': 0, 'optimized_tours': {}, 'details': []}
+    for result in results:
+        merged['total_improvement'] += result['total_improvement']
+        merged['optimized_tours'].update(result['optimized_tours'])
+        merged['details'].extend(result['details'])
+    return merged
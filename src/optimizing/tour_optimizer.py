@@ -0,0 +1,464 @@
+import itertools
+import random
+import time
+from typing import Callable, List, Dict, Tuple
+import numpy as np
+from tqdm import tqdm
+from src.optimizing.child import Child
+from src.optimizing.two_opt import two_opt_order
+from src.optimizing.held_karp import HeldKarpSolver
+from src.optimizing.annealing import AnnealingState
+from src.optimizing.moves import NeighbourMoveGenerator, apply_exchange, neighbour_lists
+from src.optimizing.parallel import pool_size, run_multi_start, run_parallel_intra
+
+
+class TourOptimizer:
+    """Main module for the optimization of the routes
+
+    Internally every tour is an int array of positions into children, the matrix index of each
+    stop and of its school are looked up once up front. Tour costs are a single gather over the
+    matrix, the child objects are only mapped back for the results.
+    """
+
+    def __init__(self,
+                 distance_matrix: np.ndarray,
+                 children: List[Child],
+                 school_positions: Dict[int, int],  # school_id -> index in matrix
+                 node_index: Dict[str, int],  # stop id -> index in matrix
+                 max_capacity: int = 8,
+                 duration_matrix: np.ndarray = None,
+                 metric: str = "distance",
+                 metric_weights: Dict[str, float] = None,
+                 two_opt_mode: str = "best",
+                 exact_max_size: int = 9,
+                 seed: int = None,
+                 parallel_min_stops: int = 500,
+                 neighbours: int = 10):
+        """
+        Args:
+            distance_matrix: NxN matrix containing distances between children
+            children: list of all children objects or stops (co-located children of a tour)
+            school_positions: mapping from school_id to index in distance matrix
+            node_index: mapping from child/stop id to index in distance matrix
+            max_capacity: max number of children per tour
+            duration_matrix: NxN matrix containing durations between children, same indices
+            metric: 'distance' or 'duration', the metric which is minimised
+            metric_weights: minimise a weighted combination instead, e.g. {'distance': 1, 'duration': 10}
+            two_opt_mode: 'best' or 'first' improvement in the 2-opt engine
+            exact_max_size: tours with up to this many stops are solved exactly with Held-Karp
+            seed: seed of the random moves, None for a random run
+            parallel_min_stops: the intra tour step runs in the process pool from this many stops on
+            neighbours: inter tour moves join a stop with one of its this many nearest stops, 0 for random moves
+        """
+        self.distance_matrix = distance_matrix
+        self.matrices = {"distance": distance_matrix, "duration": duration_matrix}
+        self.cost_matrix = self._build_cost_matrix(metric, metric_weights)
+        self.cost_unit = {"distance": "Meter", "duration": "Sekunden"}.get(metric, "") if not metric_weights else "Kostenpunkte"
+        self.node_index = node_index
+        self.two_opt_mode = two_opt_mode
+        self.exact_solver = HeldKarpSolver(self.cost_matrix, max_size=exact_max_size)
+        self.children = children
+        self.school_positions = school_positions
+        self.max_capacity = max_capacity
+        self.random = random.Random(seed)
+        self.parallel_min_stops = parallel_min_stops
+
+        # Matrix index of every stop and of the school it drives to, by position in children
+        self.stop_nodes = np.array([node_index[child.id] for child in children], dtype=np.intp)
+        self.stop_schools = np.array([school_positions[child.school_id] for child in children], dtype=np.intp)
+        # Number of children picked up at every stop, counted against max_capacity
+        self.stop_loads = np.array([len(getattr(child, "children", [child])) for child in children], dtype=np.intp)
+        # Co-located stops of different tours share an id, so objects are mapped back by identity
+        self._positions = {id(child): position for position, child in enumerate(children)}
+
+        # Nearest stops of every stop, the inter tour moves are built between close stops
+        self.neighbours = neighbour_lists(self.cost_matrix, self.stop_nodes, self.stop_schools, neighbours)
+
+        # Generate tours by assigning every child to its corresponding tour, the original plan is kept
+        self._original_tours = self._organize_tour_positions()
+        self._tours = {tour_id: tour.copy() for tour_id, tour in self._original_tours.items()}
+
+    def _build_cost_matrix(self, metric: str, metric_weights: Dict[str, float] = None) -> np.ndarray:
+        """Select the matrix which is minimised, a weighted combination is calculated once up front"""
+        if not metric_weights:
+            metric_weights = {metric: 1}
+        for name in metric_weights:
+            if self.matrices.get(name) is None:
+                raise ValueError(f"No {name} matrix available for the optimization.")
+        if len(metric_weights) == 1:
+            name, weight = next(iter(metric_weights.items()))
+            return self.matrices[name] if weight == 1 else weight * self.matrices[name]
+        return sum(weight * self.matrices[name] for name, weight in metric_weights.items())
+
+    def _organize_tours(self) -> Dict[int, List[Child]]:
+        """Organize Children into tours based on their tour_id"""
+        tours = {}
+        for child in self.children:
+            if child.tour_id not in tours:
+                tours[child.tour_id] = []
+            tours[child.tour_id].append(child)
+        return tours
+
+    def _organize_tour_positions(self) -> Dict[int, np.ndarray]:
+        """Same as _organize_tours, but every tour is an array of positions into children"""
+        return {tour_id: self._to_positions(tour) for tour_id, tour in self._organize_tours().items()}
+
+    @property
+    def tours(self) -> Dict[int, List[Child]]:
+        """Current tours as lists of children in the order of pick up"""
+        return self._to_children(self._tours)
+
+    @property
+    def original_tours(self) -> Dict[int, List[Child]]:
+        """Tours of the original plan as lists of children in the order of pick up"""
+        return self._to_children(self._original_tours)
+
+    def _to_positions(self, tour: List[Child]) -> np.ndarray:
+        return np.array([self._positions[id(child)] for child in tour], dtype=np.intp)
+
+    def _to_children(self, tours: Dict[int, np.ndarray]) -> Dict[int, List[Child]]:
+        return {tour_id: [self.children[position] for position in tour] for tour_id, tour in tours.items()}
+
+    def _tour_cost(self, tour: np.ndarray, matrix: np.ndarray = None) -> float:
+        """Cost of a tour given as positions into children, one gather over the matrix"""
+        if len(tour) == 0:
+            return 0.0
+        matrix = self.cost_matrix if matrix is None else matrix
+        nodes = self.stop_nodes[tour]
+        return float(matrix[nodes[:-1], nodes[1:]].sum() + matrix[nodes[-1], self.stop_schools[tour[0]]])
+
+    def calculate_tour_cost(self, tour: List[Child], metric: str = None) -> float:
+        """
+        Calculate the total tour costs
+
+        Args:
+            tour: Liste von Kindern in der Reihenfolge der Abholung
+            metric: 'duration' oder 'distance', default is the optimized cost
+        """
+        matrix = self.cost_matrix if metric is None else self.matrices[metric]
+        return self._tour_cost(self._to_positions(tour), matrix)
+
+    def _solve_order(self, tour: np.ndarray) -> Tuple[np.ndarray, float]:
+        """Reorder a tour on the matrix indices of the stops, exact for small tours, 2-opt otherwise
+
+        Returns:
+            reordered tour and its cost
+        """
+        if len(tour) <= 1:
+            return tour, self._tour_cost(tour)
+        nodes, school = self.stop_nodes[tour], self.stop_schools[tour[0]]
+        if len(tour) <= self.exact_solver.max_size:
+            order, cost = self.exact_solver.solve(nodes, school)
+            return tour[order], cost
+        tour = tour[two_opt_order(nodes, school, self.cost_matrix, mode=self.two_opt_mode)]
+        return tour, self._tour_cost(tour)
+
+    def _improve_order(self, tour: np.ndarray) -> np.ndarray:
+        return self._solve_order(tour)[0]
+
+    def _optimize_order(self, tour: np.ndarray) -> Tuple[np.ndarray, float]:
+        """Improve the order of a tour given as positions, returns the tour and the improvement"""
+        if len(tour) <= 1:
+            return tour, 0
+        initial_cost = self._tour_cost(tour)
+        tour = self._improve_order(tour)
+        return tour, initial_cost - self._tour_cost(tour)
+
+    def optimize_tour_order_2opt(self, tour_id: int) -> Tuple[List[Child], float]:
+        """
+        Optimize the intra tour order using 2-opt algorithm (Held-Karp for small tours)
+
+        return:
+            optimized tour and the improvement in cost
+        """
+        tour, improvement = self._optimize_order(self._tours[tour_id])
+        return [self.children[position] for position in tour], improvement
+
+    def optimize_tour_order_2opt_list(self, tour: List[Child]) -> Tuple[List[Child], float]:
+        """2-opt for a given list of children"""
+        optimized, improvement = self._optimize_order(self._to_positions(tour))
+        return [self.children[position] for position in optimized], improvement
+
+    def _optimize_intra(self, tours: Dict[int, np.ndarray]) -> Dict[str, any]:
+        """Optimize the order of every tour, large plans fan out to the process pool"""
+        n_stops = sum(len(tour) for tour in tours.values())
+        if n_stops >= self.parallel_min_stops and len(tours) > 1 and pool_size() > 1:
+            return run_parallel_intra(self.cost_matrix, self._problem(), tours)
+        return self._optimize_intra_sequential(tours)
+
+    def _optimize_intra_sequential(self, tours: Dict[int, np.ndarray]) -> Dict[str, any]:
+        total_improvement = 0
+        optimized_tours = {}
+        improvements = []
+
+        for tour_id, tour in tours.items():
+            optimized_tour, improvement = self._optimize_order(tour)
+            optimized_tours[tour_id] = optimized_tour
+            total_improvement += improvement
+            improvements.append({
+                'tour_id': tour_id,
+                'improvement': improvement,
+                'original_cost': self._tour_cost(tour),
+                'optimized_cost': self._tour_cost(optimized_tour)
+            })
+
+        return {
+            'total_improvement': total_improvement,
+            'optimized_tours': optimized_tours,
+            'details': improvements
+        }
+
+    def optimize_all_tours_intra(self) -> Dict[str, any]:
+        """
+        Optimize all tours individually using 2-opt (Held-Karp for small tours)
+
+        Returns:
+            dict with total improvement and details per tour
+        """
+        result = self._optimize_intra(self._tours)
+        result['optimized_tours'] = self._to_children(result['optimized_tours'])
+        return result
+
+    def try_swap_children(self, child1: Child, child2: Child,
+                          tour1: List[Child], tour2: List[Child]) -> Tuple[bool, float]:
+        """
+        Test if swapping two children between two tours improves the cost
+
+        Returns:
+            (is_improved, savings)
+        """
+        if child1.school_id != tour2[0].school_id or child2.school_id != tour1[0].school_id:
+            return False, 0  # Verschiedene Schulen
+
+        tour1, tour2 = self._to_positions(tour1), self._to_positions(tour2)
+        position1, position2 = self._positions[id(child1)], self._positions[id(child2)]
+        current_cost = self._tour_cost(tour1) + self._tour_cost(tour2)
+
+        new_tour1 = self._improve_order(np.where(tour1 == position1, position2, tour1))
+        new_tour2 = self._improve_order(np.where(tour2 == position2, position1, tour2))
+
+        improvement = current_cost - (self._tour_cost(new_tour1) + self._tour_cost(new_tour2))
+        return improvement > 0, improvement
+
+    def _inter_tour_search(self, tours: Dict[int, np.ndarray], max_iterations=1000,
+                           temperature=100, cooling_rate=0.995, show_progress=True,
+                           time_budget: float = None, plateau_iterations: int = None,
+                           progress: Callable[[Dict[str, any]], None] = None,
+                           should_stop: Callable[[], bool] = None, progress_interval: float = 0.5,
+                           final_temperature: float = 1.0) -> Dict[str, any]:
+        """
+        Simulated annealing over the inter tour moves. Stops after max_iterations (None for no limit),
+        when time_budget seconds have passed, after plateau_iterations without a new best solution or
+        when should_stop() returns True. progress gets the best solution so far (as positions), at most
+        every progress_interval seconds.
+
+        The temperature drops by cooling_rate per iteration, with a time_budget it follows the used share
+        of the budget instead and reaches final_temperature when the budget is spent.
+        """
+        if max_iterations is None and time_budget is None and plateau_iterations is None and should_stop is None:
+            raise ValueError("The inter tour search needs max_iterations, time_budget, plateau_iterations or should_stop.")
+        tour_ids = list(tours.keys())
+        orders = [tours[tour_id] for tour_id in tour_ids]
+        state = AnnealingState(orders, [self._tour_cost(tour) for tour in orders], len(self.children),
+                               width=self.max_capacity, stop_loads=self.stop_loads)
+        tour_ends = np.array([self.stop_schools[tour[0]] for tour in orders], dtype=np.intp)
+        generator = NeighbourMoveGenerator(self.cost_matrix, self.stop_nodes, tour_ends, self.max_capacity,
+                                           self.neighbours)
+        initial_cost = state.total
+
+        swaps_performed = []
+        moves_evaluated = moves_accepted = 0
+        temp = temperature
+        start = last_report = time.perf_counter()
+        last_best = iterations_done = 0
+        stop_reason = 'iterations'
+
+        iterations = range(max_iterations) if max_iterations is not None else itertools.count()
+        for iteration in tqdm(iterations, total=max_iterations, disable=not show_progress):
+            now = time.perf_counter()
+            if time_budget is not None and now - start >= time_budget:
+                stop_reason = 'time_budget'
+                break
+            if plateau_iterations is not None and iteration - last_best >= plateau_iterations:
+                stop_reason = 'plateau'
+                break
+            if now - last_report >= progress_interval:
+                last_report = now
+                if progress is not None:
+                    progress({
+                        'iteration': iteration,
+                        'elapsed': now - start,
+                        'best_cost': float(state.best_total),
+                        'best_tours': dict(zip(tour_ids, state.best_tours())),
+                    })
+                if should_stop is not None and should_stop():
+                    stop_reason = 'stopped'
+                    break
+            iterations_done = iteration + 1
+
+            move = generator.propose(state, self.random)
+            if time_budget:
+                temp = temperature * (final_temperature / temperature) ** ((now - start) / time_budget)
+            else:
+                temp *= cooling_rate
+            if move is None:
+                continue
+            moves_evaluated += 1
+
+            # The move is judged by its constant time delta, only accepted moves are applied and re-solved
+            if not (move.delta < 0 or self.random.random() < np.exp(-move.delta / temp)):
+                continue
+            moves_accepted += 1
+
+            tour1, tour2 = state.tour(move.a), state.tour(move.b)
+            moved1, moved2 = tour1[move.i1:move.i2].copy(), tour2[move.j1:move.j2].copy()
+            new_tour1, new_tour2 = apply_exchange(tour1, tour2, move)
+            previous = state.apply([(move.a, *self._solve_order(new_tour1)), (move.b, *self._solve_order(new_tour2))])
+            delta = sum(state.costs[k] - cost for k, _, cost in previous)
+
+            if delta < 0:
+                swaps_performed.append({
+                    'iteration': iteration,
+                    'move': move.kind,
+                    'tour1_id': tour_ids[move.a],
+                    'tour2_id': tour_ids[move.b],
+                    'child1': ", ".join(f"{self.children[k].forname} {self.children[k].surname}" for k in moved1),
+                    'child2': ", ".join(f"{self.children[k].forname} {self.children[k].surname}" for k in moved2),
+                    'improvement': -delta
+                })
+            if state.save_best():
+                last_best = iteration
+
+        return {
+            'total_improvement': float(initial_cost - state.best_total),
+            'optimized_tours': dict(zip(tour_ids, state.best_tours())),
+            'swaps_performed': swaps_performed,
+            'iterations': iterations_done,
+            'stop_reason': stop_reason,
+            'runtime': time.perf_counter() - start,
+            'moves_evaluated': moves_evaluated,
+            'moves_accepted': moves_accepted,
+            'final_cost': float(state.best_total)
+        }
+
+    def _problem(self) -> Dict[str, any]:
+        """Arguments of an optimizer in a worker process, which gets the cost matrix as distance matrix"""
+        return {
+            'children': self.children,
+            'school_positions': self.school_positions,
+            'node_index': self.node_index,
+            'max_capacity': self.max_capacity,
+            'two_opt_mode': self.two_opt_mode,
+            'exact_max_size': self.exact_solver.max_size,
+            'neighbours': self.neighbours.shape[1],
+        }
+
+    def _multi_start_search(self, tours: Dict[int, np.ndarray], chains: int, max_iterations=1000,
+                            temperature=100, cooling_rate=0.995, time_budget: float = None,
+                            plateau_iterations: int = None, progress: Callable[[Dict[str, any]], None] = None,
+                            should_stop: Callable[[], bool] = None) -> Dict[str, any]:
+        """Run independent seeded annealing chains in a process pool, the best chain wins"""
+        # The chain seeds are drawn from the optimizer seed, so a seeded multi start is reproducible
+        seeds = [self.random.randrange(2 ** 32) for _ in range(chains)]
+        return run_multi_start(self.cost_matrix, self._problem(), tours, seeds, max_iterations, temperature, cooling_rate,
+                               time_budget=time_budget, plateau_iterations=plateau_iterations, progress=progress,
+                               should_stop=should_stop)
+
+    def optimize_inter_tour_swaps(self, max_iterations=1000,
+                                  temperature=100, cooling_rate=0.995) -> Dict[str, any]:
+        """
+        Optimize inter-tour moves (relocate, swap, 2-opt*, cross exchange) using Simulated Annealing
+
+        Args:
+            max_iterations: max iteration
+            temperature: temperature
+            cooling_rate: cooling
+        """
+        result = self._inter_tour_search(self._tours, max_iterations, temperature, cooling_rate)
+        result['optimized_tours'] = self._to_children(result['optimized_tours'])
+        return result
+
+    def full_optimization(self, inter_tour_iterations=1000, status_text=None, chains=1,
+                          time_budget: float = None, plateau_iterations: int = None,
+                          progress_callback: Callable[[Dict[str, any]], None] = None,
+                          should_stop: Callable[[], bool] = None) -> Dict[str, any]:
+        """
+        Perform a full optimization in three steps:
+        1. Intra-Tour-Optimizing (Oder)
+        2. Inter-Tour-Optimizing (Swaps)
+        3. Another Intra-Tour-Optimizing
+
+        status_text is optional, e.g. a streamlit placeholder, the optimizer itself runs headless.
+        With chains > 1 the inter tour step runs that many annealing chains in parallel processes.
+
+        Anytime mode: with a time_budget in seconds (inter_tour_iterations may then be None) the
+        inter tour step stops when the budget is used up, after plateau_iterations without a new
+        best solution or when should_stop() returns True. progress_callback gets the iteration,
+        elapsed time, best cost, improvement and best tours so far (of the best chain).
+        """
+        def report(message: str):
+            if status_text is not None:
+                status_text.text(message)
+
+        start = time.perf_counter()
+        initial_cost = sum(self._tour_cost(tour) for tour in self._tours.values())
+
+        def on_progress(stats: Dict[str, any]):
+            stats['elapsed'] = time.perf_counter() - start
+            stats['improvement'] = initial_cost - stats['best_cost']
+            stats['best_tours'] = self._to_children(stats['best_tours'])
+            progress_callback(stats)
+
+        report("🔄 Starte die erste Intra-Tour-Optimierung...")
+        intra_result1 = self._optimize_intra(self._tours)
+
+        # Update tours mit optimierten Reihenfolgen
+        report(f"🔄 Ersparnisse nach der ersten Runde {round(intra_result1['total_improvement'], 2)} {self.cost_unit}")
+        self._tours = intra_result1['optimized_tours']
+
+        if len(self._tours) < 2:
+            intra_result1['optimized_tours'] = self._to_children(intra_result1['optimized_tours'])
+            return {
+                'total_improvement': intra_result1['total_improvement'],
+                'intra_optimization_1': intra_result1,
+                'inter_optimization': None,
+                'intra_optimization_2': None,
+                'final_tours': intra_result1['optimized_tours']
+            }
+
+        report("🔄 Starte die Inter-Tour-Optimierung...")
+        # The intra tour step counts against the time budget as well
+        budget = None if time_budget is None else max(0.0, time_budget - (time.perf_counter() - start))
+        if chains > 1:
+            inter_result = self._multi_start_search(self._tours, chains, max_iterations=inter_tour_iterations,
+                                                    time_budget=budget, plateau_iterations=plateau_iterations,
+                                                    progress=on_progress if progress_callback else None,
+                                                    should_stop=should_stop)
+        else:
+            inter_result = self._inter_tour_search(self._tours, max_iterations=inter_tour_iterations,
+                                                   time_budget=budget, plateau_iterations=plateau_iterations,
+                                                   progress=on_progress if progress_callback else None,
+                                                   should_stop=should_stop)
+        report(f"🔄 Ersparnisse nach der Inter-Tour-Optimierung {round(inter_result['total_improvement'], 2)} {self.cost_unit}")
+        # Update tours mit Swap-Ergebnissen
+        self._tours = inter_result['optimized_tours']
+
+        report("🔄 Starte die zweite Intra-Tour-Optimierung...")
+        intra_result2 = self._optimize_intra(self._tours)
+        self._tours = intra_result2['optimized_tours']
+
+        total_improvement = (intra_result1['total_improvement'] +
+                             inter_result['total_improvement'] +
+                             intra_result2['total_improvement'])
+
+        # Map the positions back to the children only for the results
+        for result in (intra_result1, inter_result, intra_result2):
+            result['optimized_tours'] = self._to_children(result['optimized_tours'])
+
+        return {
+            'total_improvement': total_improvement,
+            'intra_optimization_1': intra_result1,
+            'inter_optimization': inter_result,
+            'intra_optimization_2': intra_result2,
+            'final_tours': intra_result2['optimized_tours']
+        }
@@ -1,79 +1,81 @@
 from typing import List, Callable
 import streamlit as st
 import pandas as pd
-import numpy as np
 from src.utils.geolocation import GeoLocation
 from src.optimizing.osmr.osm_routing import OSMR_Module
-from src.optimizing.child import Child, create_object, Object, School
+from src.optimizing.child import Child, create_object, School, Stop, create_location_id
+from src.optimizing.distance_matrix import DistanceMatrix
 
 
 class OptimizingDataset:
     """Module to generate the Dataset needed for Optimizing the Routs"""
     @staticmethod
-    def _get_distance_matrix_from_osmr(children: List[Child], school: Object,
-                                       update_pogress: Callable, status_text, osmr_url: str) -> pd.DataFrame:
+    def _update_distance_matrix_from_osmr(distance_matrix: DistanceMatrix, children: List[Child], school: School,
+                                          update_pogress: Callable, status_text, osmr_url: str) -> DistanceMatrix:
         # First get the geolocations of all children
         status_text.text("Ermittle Geokoordinaten der Adressen...")
         children, school = GeoLocation().geocode_addresses(children, school)
-        # Then get the distance matrix from OpenStreetMap
+        # Co-located children (e.g. siblings) share a single node of the matrix
+        nodes = {create_location_id(child): (child.lat, child.lon) for child in children}
+        nodes[create_location_id(school)] = (school.lat, school.lon)
+        # Then request the missing entries of the distance matrix from OpenStreetMap
         osmr_module = OSMR_Module(maps=False, osmr_url=osmr_url)
         status_text.text("Erstelle Distanzmatrix von OpenStreetMap...")
-        distance_matrix = osmr_module.create_distance_matrix_from_osmr(children, school, update_pogress)
+        distance_matrix = osmr_module.update_distance_matrix(distance_matrix, nodes, update_pogress,
+                                                             anchors=[create_location_id(school)])
         if distance_matrix is None:
             st.sidebar.error("Fehler beim Erstellen der Distanzmatrix von OpenStreetMap.")
             return None
+        status_text.text(f"Distanzmatrix erstellt: {osmr_module.cache_stats['hits']} Distanzen aus dem Cache, "
+                         f"{osmr_module.cache_stats['misses']} von OpenStreetMap geladen, "
+                         f"{osmr_module.cache_stats['estimated']} geschätzt")
         return distance_matrix
 
-    @staticmethod
-    def _check_distance_matrix(children: List[Child]) -> bool:
-        """Check if all Person-to-Person information entries are within the distance matrix."""
-        if "children_to_index" not in st.session_state:
-            return False
-
-        children_to_index: dict = st.session_state["children_to_index"]
-        if len(children) != len(children_to_index):
-            return False
-        child_ids = {child.id for child in children}
-
-        return all(child_id in child_ids for child_id in children_to_index.keys())
-
     @staticmethod
     def load_distance_matrix(children: List[Child], school: School,
-                             update_pogress: Callable, status_text, osmr_url: str) -> dict:
-        """Load distance matrix from the current session_state or load it from OpenStreetMap"""
+                             update_pogress: Callable, status_text, osmr_url: str) -> DistanceMatrix:
+        """Load the distance matrix of the current session and update it for added, removed or edited children"""
         assert len(children) > 0, "No children provided to load distance matrix."
-        if "distance_matrix" in st.session_state:
-            if OptimizingDataset._check_distance_matrix(children=children):
-                return st.session_state.distance_matrix
-        # Load the distance matrix from OpenStreetMap
-        new_distance_matrix = OptimizingDataset._get_distance_matrix_from_osmr(children, school, update_pogress, status_text, osmr_url)
-        if new_distance_matrix is None:
+        distance_matrix = st.session_state.get("distance_matrix")
+        if not isinstance(distance_matrix, DistanceMatrix):
+            distance_matrix = DistanceMatrix()
+        distance_matrix = OptimizingDataset._update_distance_matrix_from_osmr(distance_matrix, children, school,
+                                                                             update_pogress, status_text, osmr_url)
+        if distance_matrix is None:
             st.sidebar.error("Fehler beim Laden der Distanzmatrix von OpenStreetMap.")
             return None
-        st.session_state.distance_matrix = new_distance_matrix
-        return new_distance_matrix
+        # Remove the holes of dropped children once they make up more than half of the matrix
+        if len(distance_matrix.free) > len(distance_matrix):
+            distance_matrix.compact()
+        st.session_state.distance_matrix = distance_matrix
+        return distance_matrix
 
     @staticmethod
-    def get_school_indeces(distance_matrix: np.ndarray, school: School) -> list[int]:
+    def get_school_indeces(distance_matrix: DistanceMatrix, school: School) -> dict:
         """Get the indeces of all Schools in the distance matrix"""
-        school_indeces = []
-        for i in range(distance_matrix.shape[0]):
-            for j in range(distance_matrix.shape[1]):
-                # Schools are marked with -1 in the distance matrix
-                if distance_matrix[i][j] == -1:
-                    school_indeces.append(i)
-        return {school.id: distance_matrix.shape[0]-1}
+        return {school.id: distance_matrix.index_of(create_location_id(school))}
+
+    @staticmethod
+    def group_children_into_stops(children: List[Child]) -> List[Stop]:
+        """Group the children of every tour by their location, keeping the order of the first child per stop."""
+        stops = {}
+        for child in children:
+            key = (child.tour_id, create_location_id(child))
+            if key not in stops:
+                stops[key] = Stop(id=key[1], children=[])
+            stops[key].children.append(child)
+        return list(stops.values())
 
     @staticmethod
-    def turn_children_list_into_tour_dict(tour_to_children_dict: dict, school: School) -> dict:
-        """Turn a dict of tour_id to a list of Child objects into a tour dict with DataFrames."""
+    def turn_children_list_into_tour_dict(tour_to_stops_dict: dict, school: School) -> dict:
+        """Turn a dict of tour_id to a list of Stop objects into a tour dict with DataFrames, one row per child."""
         tour_dict = {}
 
-        for tour_id, children in tour_to_children_dict.items():
+        for tour_id, stops in tour_to_stops_dict.items():
             tour_rows = []
 
-            # Add children rows
-            for child in children:
+            # Add children rows, the children of a stop are expanded in their original order
+            for child in [child for stop in stops for child in stop.children]:
                 row = {
                     "fornames": child.forname,
                     "surnames": child.surname,
@@ -140,7 +142,7 @@ class OptimizingDataset:
         return children, school
 
     @staticmethod
-    def generate_optimizing_dataset(update_progress: Callable, status_text, osmr_url: str) -> tuple[np.ndarray, list[int], list[Child]]:
+    def generate_optimizing_dataset(update_progress: Callable, status_text, osmr_url: str) -> tuple[DistanceMatrix, dict, list[Stop], School]:
         """Generate the dataset needed for optimizing the routes"""
         if "tour_id_to_df" not in st.session_state:
             st.error("Keine Tourdaten gefunden. Bitte zuerst Touren hochladen.")
@@ -151,5 +153,8 @@ class OptimizingDataset:
         status_text.text("Lade Distanzmatrix von OpenStreetMap...")
         distance_matrix = OptimizingDataset.load_distance_matrix(children, school, update_progress,
                                                                  status_text, osmr_url)
+        if distance_matrix is None:
+            return None, None, None, school
         school_indeces = OptimizingDataset.get_school_indeces(distance_matrix, school)
-        return distance_matrix, school_indeces, children, school
+        stops = OptimizingDataset.group_children_into_stops(children)
+        return distance_matrix, school_indeces, stops, school
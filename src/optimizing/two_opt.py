@@ -0,0 +1,61 @@
+from typing import Sequence, Tuple
+import numpy as np
+
+
+def path_cost(nodes: Sequence[int], end: int, matrix: np.ndarray) -> float:
+    """Cost of visiting the nodes in order and finishing at the end node (the school)."""
+    if len(nodes) == 0:
+        return 0
+    nodes = np.asarray(nodes)
+    return float(matrix[nodes[:-1], nodes[1:]].sum() + matrix[nodes[-1], end])
+
+
+def two_opt_deltas(nodes: np.ndarray, end: int, matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Cost delta of reversing every segment nodes[i..j] of an open path ending at end.
+
+    Every delta only needs the four endpoints of the two replaced edges. The matrix may be
+    asymmetric, so the reversed segment is re-summed from prefix sums of the backward edges.
+
+    Returns:
+        (i, j, delta) arrays over all candidate segments, in scan order
+    """
+    n = len(nodes)
+    extended = np.append(nodes, end)
+    forward = np.concatenate(([0], np.cumsum(matrix[nodes[:-1], nodes[1:]])))
+    backward = np.concatenate(([0], np.cumsum(matrix[nodes[1:], nodes[:-1]])))
+
+    i, j = np.triu_indices(n, k=1)
+    following = extended[j + 1]
+    delta = (matrix[nodes[i], following] - matrix[nodes[j], following] +
+             (backward[j] - backward[i]) - (forward[j] - forward[i]))
+    # The path has an open start, a segment starting at the first node has no edge before it
+    has_previous = i > 0
+    previous = nodes[i - 1][has_previous]
+    delta[has_previous] += (matrix[previous, nodes[j][has_previous]] - matrix[previous, nodes[i][has_previous]])
+    return i, j, delta
+
+
+def two_opt_order(nodes: Sequence[int], end: int, matrix: np.ndarray, mode: str = "best",
+                  epsilon: float = 1e-9) -> np.ndarray:
+    """Improve the visiting order of an open path ending at end with 2-opt moves.
+
+    Args:
+        nodes: matrix indices of the stops in visiting order
+        end: matrix index of the fixed end node (the school)
+        matrix: cost matrix
+        mode: 'best' applies the best move per pass, 'first' the first improving move in scan order
+
+    Returns:
+        improved order as positions into nodes
+    """
+    order = np.arange(len(nodes))
+    if len(nodes) <= 1:
+        return order
+    nodes = np.asarray(nodes)
+    while True:
+        i, j, delta = two_opt_deltas(nodes[order], end, matrix)
+        improving = delta < -epsilon
+        if not improving.any():
+            return order
+        move = np.argmin(delta) if mode == "best" else np.argmax(improving)
+        order[i[move]:j[move] + 1] = order[i[move]:j[move] + 1][::-1]
@@ -5,12 +5,13 @@ import os
 import hashlib
 from typing import Tuple, List
 from dataclasses import dataclass
-from src.geocaching import GeocodingCache
+from src.geocaching import GeocodingCache, get_geocoding_cache
 from src.document_parsing import pdf_parser
 from src.map_creation import create_maps_for_tours
 from src.create_doc_files import turn_df_into_word, turn_changes_into_word
 from src.utils.utils import merge_editable_df_into_original, show_optimized_informations
 from src.optimizing.optimizer import OptimizerModule
+from src.optimizing.osmr.osm_routing import OSMR_Module
 
 
 
@@ -27,11 +28,11 @@ class SessionStateKeys:
     FILE_PROCESSED = "file_processed"
     GENERATING_MAPS = "generating_maps"  # NEW: Track if maps are being generated
     CHANGES = "changes"  # track changes done by optimization
-    CHILDREN_TO_INDEX = "children_to_index"  # NEW: Map child IDs to their indices in the distance matrix
-    DISTANCE_MATRIX = "distance_matrix"  # NEW: Store the distance matrix
+    DISTANCE_MATRIX = "distance_matrix"  # NEW: Store the distance matrix incl. the child ID -> index mapping
     OPTIMIZATION_INFOS = "optimization_infos"  # NEW: Store optimization infos
     OPTIMIZED_DISTANCES = "optimized_distances"  # NEW: Store distances for optimized tours
-    GEOCODING_CACHE = "geocoding_cache"  # NEW: Cache for children's addresses
+    STOP_OPTIMIZATION = OptimizerModule.STOP_KEY  # Stop button of a running optimization was clicked
+    PARTIAL_OPTIMIZATION = OptimizerModule.PARTIAL_KEY  # Best tours so far of a running optimization
 
 
 
@@ -72,22 +73,18 @@ class SessionManager:
             SessionStateKeys.GENERATING_MAPS: False,  # NEW
             SessionStateKeys.CHANGES: {}, # NEW
             SessionStateKeys.OPTIMIZED_TOUR_TO_DF: {},
-            SessionStateKeys.CHILDREN_TO_INDEX: {},
-            SessionStateKeys.DISTANCE_MATRIX: pd.DataFrame(),
+            SessionStateKeys.DISTANCE_MATRIX: None,
             SessionStateKeys.OPTIMIZATION_INFOS: {},
             SessionStateKeys.OPTIMIZED_DISTANCES: {},
             SessionStateKeys.OPTIMIZED_MAPS: [],
-            SessionStateKeys.GEOCODING_CACHE: {},
+            SessionStateKeys.STOP_OPTIMIZATION: False,
+            SessionStateKeys.PARTIAL_OPTIMIZATION: None,
 
         }
         for key, default_value in defaults.items():
             if key not in st.session_state:
                 st.session_state[key] = default_value
 
-        with open(os.getenv("ADRESS_PATH"), "r") as f:
-            import json
-            st.session_state[SessionStateKeys.GEOCODING_CACHE] = json.load(f)
-
     @staticmethod
     def reset_tour_data():
         """Reset tour-related session state when new file is uploaded."""
@@ -102,12 +99,9 @@ class SessionManager:
         st.session_state[SessionStateKeys.GENERATING_MAPS] = False
         st.session_state[SessionStateKeys.CHANGES] = {}
         st.session_state[SessionStateKeys.OPTIMIZED_TOUR_TO_DF] = {}
-        st.session_state[SessionStateKeys.CHILDREN_TO_INDEX] = {}
-        st.session_state[SessionStateKeys.DISTANCE_MATRIX] = pd.DataFrame()
         st.session_state[SessionStateKeys.OPTIMIZATION_INFOS] = {}
         st.session_state[SessionStateKeys.OPTIMIZED_DISTANCES] = {}
         st.session_state[SessionStateKeys.OPTIMIZED_MAPS] = []
-        st.session_state[SessionStateKeys.GEOCODING_CACHE] = {}
 
 
     @staticmethod
@@ -166,8 +160,26 @@ class UIComponents:
         st.sidebar.text("--------------Historie----------------")
         st.sidebar.info("Die Historie vergangener Touren wird später hier dargestellt")
 
+        UIComponents.render_osrm_status()
+
         return api_key_input, googlemaps.Client(key=api_key_input)
 
+    @staticmethod
+    def render_osrm_status():
+        """Render the cached health state of the OSRM instance."""
+        osmr_module = OSMR_Module(maps=False)
+        osmr_module.is_osmr_url_reachable()
+        status = osmr_module.health.status()
+
+        st.sidebar.text("-------------OSRM-Status--------------")
+        if status["state"] == "open":
+            st.sidebar.error(f"OSRM nicht erreichbar ({status['consecutive_failures']} Fehler in Folge). "
+                             f"Neuer Versuch in {round(status['retry_in'])} Sekunden.")
+        elif status["available"]:
+            st.sidebar.success("OSRM erreichbar")
+        else:
+            st.sidebar.warning("OSRM antwortet nicht")
+
     @staticmethod
     def render_metrics(tour_distances: List[float]):
         """Render tour metrics."""
@@ -215,6 +227,11 @@ class TourTableTab:
         "Region": "regions"
     }
 
+    METRIC_MAPPING = {
+        "Distanz": "distance",
+        "Fahrzeit": "duration"
+    }
+
     @classmethod
     def render(cls, tour_distances: List[float]) -> pd.DataFrame:
         """Render the tour table tab with editable data."""
@@ -386,21 +403,54 @@ class TourTableTab:
             )
 
         with col2:
-            if st.button("🔄 Optimiere die Touren...", width="stretch"):
-                with st.spinner("Optimiere die Tour...", show_time=True):
-                    optimizer = OptimizerModule({})
-                    optimized_tours, changes, optimization_infos, optimized_distances, osm_distances = optimizer.optimize()
-                    st.session_state[SessionStateKeys.OPTIMIZED_TOUR_TO_DF] = optimized_tours
-                    st.session_state[SessionStateKeys.CHANGES] = changes
-                    st.session_state[SessionStateKeys.OPTIMIZATION_INFOS] = optimization_infos
-                    st.session_state[SessionStateKeys.OPTIMIZED_DISTANCES] = optimized_distances
-                    st.session_state[SessionStateKeys.TOUR_DISTANCE] = osm_distances
-                    st.success("Touren erfolgreich optimiert!")
+            metric_choice = st.selectbox(
+                "Optimierungsziel:",
+                list(cls.METRIC_MAPPING.keys()),
+                key="optimization_metric"
+            )
+            time_budget = st.number_input(
+                "Zeitbudget (Sekunden):",
+                min_value=5,
+                max_value=600,
+                value=30,
+                step=5,
+                key="optimization_time_budget"
+            )
+            optimize_clicked = st.button("🔄 Optimiere die Touren...", width="stretch")
+            # Rendered before the optimization runs, so it can be clicked while it is running
+            st.button("⏹️ Optimierung stoppen", width="stretch", on_click=cls._request_stop)
+            optimizer = OptimizerModule({"metric": cls.METRIC_MAPPING[metric_choice], "time_budget": time_budget})
+
+            if st.session_state[SessionStateKeys.STOP_OPTIMIZATION]:
+                results = optimizer.finish_stopped()
+                if results:
+                    cls._store_optimization_results(results)
+                    st.success("Optimierung gestoppt, das beste Zwischenergebnis wurde übernommen!")
                     st.rerun()
+            elif optimize_clicked:
+                with st.spinner("Optimiere die Tour...", show_time=True):
+                    results = optimizer.optimize()
+                    if results:
+                        cls._store_optimization_results(results)
+                        st.success("Touren erfolgreich optimiert!")
+                        st.rerun()
 
 
         return df if not is_optimized else optimized_df
 
+    @staticmethod
+    def _request_stop():
+        st.session_state[SessionStateKeys.STOP_OPTIMIZATION] = True
+
+    @staticmethod
+    def _store_optimization_results(results):
+        optimized_tours, changes, optimization_infos, optimized_distances, osm_distances = results
+        st.session_state[SessionStateKeys.OPTIMIZED_TOUR_TO_DF] = optimized_tours
+        st.session_state[SessionStateKeys.CHANGES] = changes
+        st.session_state[SessionStateKeys.OPTIMIZATION_INFOS] = optimization_infos
+        st.session_state[SessionStateKeys.OPTIMIZED_DISTANCES] = optimized_distances
+        st.session_state[SessionStateKeys.TOUR_DISTANCE] = osm_distances
+
 
 class MapTab:
     """Handles the map tab functionality."""
@@ -472,7 +522,7 @@ class TourenplanApp:
 
     def __init__(self):
         #TODO load uder data and set session states
-        self.geocoding_cache = GeocodingCache()
+        self.geocoding_cache = get_geocoding_cache()
         SessionManager.initialize_session_state()
         SessionManager.load_user_data_and_history()
 
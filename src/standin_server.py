@@ -0,0 +1,212 @@
+"""Lightweight stand-in for the OSRM and Nominatim services used by the app.
+
+Speaks the subset of the APIs the pipeline uses (OSRM /route and /table, Nominatim /search) and answers
+deterministically from haversine distances, so the pipeline can be benchmarked and tested without the
+Bayern OSRM extract. Latency and failures can be injected.
+
+Example:
+    python -m src.standin_server --port 5001 --latency 0.005 --failure-rate 0.01
+
+    OSMR_URL="http://127.0.0.1:5001/route/v1/driving/{},{};{},{}?steps=false"
+    OSMR_MAPS_URL="http://127.0.0.1:5001/route/v1/driving/"
+    OSMR_TABLE_URL="http://127.0.0.1:5001/table/v1/driving/"
+    GEOCODED_URL="http://127.0.0.1:5001"
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import List, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+import argparse
+import hashlib
+import json
+import logging
+import random
+import time
+import numpy as np
+import polyline
+from src.optimizing.distance_matrix import haversine_matrix
+
+
+class StandInConfig:
+    """Behaviour of the stand-in server"""
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, failure_rate: float = 0.0,
+                 hang_rate: float = 0.0, hang_seconds: float = 15.0, detour_factor: float = 1.3,
+                 speed_kmh: float = 30.0, max_table_size: int = 100, center: Tuple[float, float] = (49.79, 9.95),
+                 radius_km: float = 10.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.detour_factor = detour_factor
+        self.speed = speed_kmh / 3.6  # m/s
+        self.max_table_size = max_table_size
+        self.center = center
+        self.radius_km = radius_km
+        self.random = random.Random(seed)
+        self.lock = Lock()
+
+    def draw(self) -> Tuple[float, float]:
+        """Draw the jitter and the failure decision for one request."""
+        with self.lock:
+            return self.random.uniform(0, self.jitter), self.random.random()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers OSRM and Nominatim requests from haversine distances"""
+    protocol_version = "HTTP/1.1"  # Keep-alive, like osrm-routed
+    config: StandInConfig = None
+
+    def log_message(self, format, *args):
+        logging.debug(f"Stand-in server: {format % args}")
+
+    def do_GET(self):
+        jitter, draw = self.config.draw()
+        time.sleep(self.config.latency + jitter)
+        if draw < self.config.failure_rate:
+            return self._send(503, {"code": "ServiceUnavailable", "message": "Injected failure"})
+        if draw < self.config.failure_rate + self.config.hang_rate:
+            time.sleep(self.config.hang_seconds)
+
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = url.path.strip("/").split("/")
+        try:
+            if len(parts) == 4 and parts[0] == "route":
+                return self._send(*self._route(self._coordinates(parts[3])))
+            if len(parts) == 4 and parts[0] == "table":
+                return self._send(*self._table(self._coordinates(parts[3]), params))
+            if parts == ["search"]:
+                return self._send(200, self._search(params))
+        except ValueError as e:
+            return self._send(400, {"code": "InvalidQuery", "message": str(e)})
+        return self._send(400, {"code": "InvalidUrl", "message": f"URL string malformed: {url.path}"})
+
+    def _send(self, status: int, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    @staticmethod
+    def _coordinates(coordinates_str: str) -> List[Tuple[float, float]]:
+        """Parse OSRM 'lon,lat;lon,lat' coordinates into (lat, lon) points."""
+        points = []
+        for pair in unquote(coordinates_str).split(";"):
+            lon, lat = pair.split(",")
+            points.append((float(lat), float(lon)))
+        if len(points) < 2:
+            raise ValueError("At least two coordinates are required")
+        return points
+
+    def _distances(self, points: List[Tuple[float, float]]) -> Tuple[np.ndarray, np.ndarray]:
+        distances = haversine_matrix(points) * self.config.detour_factor
+        return distances, distances / self.config.speed
+
+    def _route(self, points: List[Tuple[float, float]]):
+        distances, durations = self._distances(points)
+        legs = [{"distance": float(distances[i, i + 1]), "duration": float(durations[i, i + 1]),
+                 "steps": [], "summary": ""} for i in range(len(points) - 1)]
+        route = {
+            "distance": sum(leg["distance"] for leg in legs),
+            "duration": sum(leg["duration"] for leg in legs),
+            "geometry": polyline.encode(points),
+            "legs": legs,
+            "weight": sum(leg["duration"] for leg in legs),
+            "weight_name": "routability",
+        }
+        waypoints = [{"location": [lon, lat], "name": "", "distance": 0} for lat, lon in points]
+        return 200, {"code": "Ok", "routes": [route], "waypoints": waypoints}
+
+    def _table(self, points: List[Tuple[float, float]], params: dict):
+        def indices(name: str) -> List[int]:
+            if params.get(name, "all") == "all":
+                return list(range(len(points)))
+            return [int(index) for index in params[name].split(";")]
+
+        sources, destinations = indices("sources"), indices("destinations")
+        if len(sources) * len(destinations) > self.config.max_table_size ** 2:
+            return 400, {"code": "TooBig", "message": "Too many table coordinates"}
+        distances, durations = self._distances(points)
+        body = {"code": "Ok",
+                "sources": [{"location": [points[i][1], points[i][0]], "name": ""} for i in sources],
+                "destinations": [{"location": [points[i][1], points[i][0]], "name": ""} for i in destinations]}
+        annotations = params.get("annotations", "duration").split(",")
+        if "distance" in annotations:
+            body["distances"] = distances[np.ix_(sources, destinations)].round(1).tolist()
+        if "duration" in annotations:
+            body["durations"] = durations[np.ix_(sources, destinations)].round(1).tolist()
+        return 200, body
+
+    def _search(self, params: dict):
+        """Place every query at a deterministic pseudo-random point around the center."""
+        query = " ".join(str(params.get(key, "")).strip().lower()
+                         for key in ("q", "street", "postalcode", "postcode", "city"))
+        if not query.strip():
+            return []
+        digest = hashlib.sha256(query.encode("utf-8")).digest()
+        angle = int.from_bytes(digest[:4], "big") / 2 ** 32 * 2 * np.pi
+        distance = np.sqrt(int.from_bytes(digest[4:8], "big") / 2 ** 32) * self.config.radius_km
+        lat = self.config.center[0] + distance / 111.32 * np.cos(angle)
+        lon = self.config.center[1] + distance / (111.32 * np.cos(np.radians(self.config.center[0]))) * np.sin(angle)
+        return [{"lat": f"{lat:.7f}", "lon": f"{lon:.7f}", "display_name": query, "importance": 0.5}]
+
+
+class StandInServer:
+    """Run the stand-in server in a background thread, e.g. for benchmarks."""
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, config: StandInConfig = None):
+        handler = type("ConfiguredStandInHandler", (StandInHandler,), {"config": config or StandInConfig()})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StandInServer":
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in for the OSRM and Nominatim services")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--latency", type=float, default=0.0, help="fixed latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="max additional random latency in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="share of requests delayed by --hang-seconds")
+    parser.add_argument("--hang-seconds", type=float, default=15.0)
+    parser.add_argument("--max-table-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = StandInConfig(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                           hang_rate=args.hang_rate, hang_seconds=args.hang_seconds,
+                           max_table_size=args.max_table_size, seed=args.seed)
+    server = StandInServer(args.host, args.port, config)
+    logging.info(f"Stand-in server listening on {server.url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    main()
@@ -4,14 +4,15 @@ import logging
 import googlemaps
 import streamlit as st
 import os
+from src.geocaching import get_geocoding_cache
 from src.optimizing.child import Child, Object, School
+from src.geocoding.address_normalization import canonical_address
+from src.geocoding.batch_geocoding import BatchGeocoder, GeocodingResult
 from src.geocoding.osmr_geocoding import GeoCoder
 
 class GeoLocation:
     def __init__(self):
-        if "geocoding_cache" not in st.session_state:
-            st.session_state["geocoding_cache"] = {}
-        self.cache = st.session_state["geocoding_cache"]
+        self.cache = get_geocoding_cache()
         self.geocoding_type = os.getenv("CODING_TYPE", "GM")
 
     @staticmethod
@@ -19,7 +20,7 @@ class GeoLocation:
         """Check whether the local OSM/Nominatim API URL is set"""
         osm_url = os.getenv("GEOCODED_URL", None)  # default lokal
         gmaps_api_key = os.getenv("GMAPS_API_KEY", None)
-        if not osm_url and not gmaps_api_key:
+        if not osm_url and not gmaps_api_key and os.getenv("CODING_TYPE") != "OFFLINE":
             logging.error("Neither GEOCODED_URL nor GMAPS_API_KEY environment variables are set.")
             st.sidebar.error("Please set either GEOCODED_URL or GMAPS_API_KEY environment variable.")
 
@@ -37,40 +38,33 @@ class GeoLocation:
             return f"{childOrSchool[0]} {childOrSchool[1]}, {childOrSchool[2]} {childOrSchool[3]}, Deutschland"
         else:
             raise ValueError("Child or School Objekt must be List or Objekt to generate address")
-    def geocode_single_adresse(self, address: dict, adress_name: str, childOrSchool: Object, osm_instance: GeoCoder):
-        if adress_name in self.cache:
-            lat, lon = self.cache[adress_name]
-            childOrSchool.lat, childOrSchool.lon = lat, lon
-        else:
-            try:
-                lat, lon = osm_instance.geocode(coding_type=self.geocoding_type, **address)
-                if lat and lon:
-                    self.cache[adress_name] = (lat, lon)
-                    childOrSchool.lat, childOrSchool.lon = lat, lon
-                else:
-                    logging.warning(f"Geocoding failed for address: {adress_name}")
-                    self.cache[adress_name] = (None, None)
-            except Exception as e:
-                logging.error(f"Error geocoding address {adress_name}: {e}")
-                self.cache[adress_name] = (None, None)
 
+    def geocode_batch(self, addresses: List[str], params: List[dict], desc: str) -> List[GeocodingResult]:
+        """Geocode all addresses concurrently, known addresses are answered from the geocoding cache"""
+        osm_instance = GeoCoder(*self.check_for_osmr_port_key_and_gmaps())
+        with tqdm(desc=desc) as progress_bar:
+            def progress(done: int, total: int):
+                progress_bar.total = total
+                progress_bar.update(1)
+
+            results = osm_instance.geocode_batch(self.geocoding_type, addresses, params, cache=self.cache,
+                                                 progress=progress)
+        logging.info(f"Geocoding cache: {self.cache.stats()}")
+        return results
 
     def geocode_addresses(self, children: List[Child], school: School) -> (List[Child], School):
         """Geocode a list of Child objects and update their lat/lon."""
-        osm_instance = GeoCoder(*self.check_for_osmr_port_key_and_gmaps())
+        objects = children + [school]
+        addresses = [canonical_address(obj.street, obj.housenumber, obj.postcode, obj.region) for obj in objects]
+        params = [{"street": f"{child.street} {child.housenumber}", "city": child.region, "postcode": child.postcode}
+                  for child in children]
+        # The school uses the region of the children
+        params.append({"street": f"{school.street} {school.housenumber}",
+                       "city": children[-1].region if children else school.region, "postcode": school.postcode})
 
-        for child in tqdm(children, desc="Geocoding addresses"):
-            address = self._format_address_from_object_or_string(child)
-            address_dict =  {"street": f"{child.street} {child.housenumber}", "city": child.region, "postcode": child.postcode}
-            self.geocode_single_adresse(address_dict, address, child, osm_instance)
-        # Geocode school address
-        school_address = self._format_address_from_object_or_string(school)
-        address_dict = {"street": f"{school.street} {school.housenumber}", "city": child.region,
-                        "postcode": school.postcode}
-        self.geocode_single_adresse(address_dict, school_address, school, osm_instance)
-        with open("./addresses.txt", "w") as f:
-            import json
-            f.write(json.dumps(self.cache))
+        for obj, result in zip(objects, self.geocode_batch(addresses, params, "Geocoding addresses")):
+            if result.found:
+                obj.lat, obj.lon = result.lat, result.lon
         for chld in children:
             if chld.lat is None or chld.lon is None:
                 logging.info(f"Child ID {chld} could not be geocoded.")
@@ -91,7 +85,6 @@ class GeoLocation:
             dict: { "address string": {"lat": float, "lng": float}, ... }
         """
 
-        osm_instance = GeoCoder(*self.check_for_osmr_port_key_and_gmaps())
         valid_locations = {}
 
         # Ensure all lists are the same length
@@ -99,9 +92,10 @@ class GeoLocation:
         if not all(len(v) == length for v in params.values()):
             raise ValueError("All address component lists must have the same length")
 
-        # Combine components into full address strings
+        # Combine components into full address strings, the cache uses the canonical form
         addresses = []
         full_addresses = []
+        keys = []
         for i in range(length):
             parts = []
             adress_dict = {}
@@ -112,28 +106,15 @@ class GeoLocation:
             full_address = self._format_address_from_object_or_string(parts)
             full_addresses.append(full_address)
             addresses.append(adress_dict)
+            keys.append(canonical_address(adress_dict.get("street"), adress_dict.get("housenumber"),
+                                          adress_dict.get("postcode"), adress_dict.get("city")))
 
-        num_cache_hits = 0
-        for i, address in tqdm(enumerate(addresses), desc="Geocoding addresses from dict"):
-            full_address = full_addresses[i]
-            if full_address in self.cache:
-                num_cache_hits += 1
-                lat, lon = self.cache[full_address]
-                if lat is not None and lon is not None:
-                    valid_locations[full_address] = {"lat": lat, "lng": lon}
-            else:
-                try:
-                    lat, lon = osm_instance.geocode(coding_type=self.geocoding_type, **address)
-                    if lat and lon:
-                        self.cache[full_address] = (lat, lon)
-                        valid_locations[full_address] = {"lat": lat, "lng": lon}
-                    else:
-                        logging.warning(f"Geocoding failed for address: {full_address}")
-                        self.cache[full_address] = (None, None)
-                except Exception as e:
-                    logging.error(f"Error geocoding address {full_address}: {e}")
-                    self.cache[full_address] = (None, None)
+        results = self.geocode_batch(keys, addresses, "Geocoding addresses from dict")
+        for full_address, result in zip(full_addresses, results):
+            if result.found:
+                valid_locations[full_address] = {"lat": result.lat, "lng": result.lon}
         logging.info(f"Valid Location: {valid_locations}")
 
+        num_cache_hits = sum(result.status == BatchGeocoder.CACHED for result in results)
         logging.info(f"Geocoding completed with {num_cache_hits} cache hits out of {len(addresses)} addresses.")
         return valid_locations, full_addresses